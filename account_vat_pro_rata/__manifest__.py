@@ -4,7 +4,7 @@
 
 {
     'name': 'VAT Pro Rata',
-    'version': '14.0.1.0.0',
+    'version': '14.0.2.1.0',
     'category': 'Accounting & Finance',
     'license': 'AGPL-3',
     'summary': 'Manages VAT Pro Rata',
@@ -16,6 +16,16 @@ This module helps to manage VAT Pro Rata. Specifications for the implementation
 
 To know more about the rules of VAT Pro Rata in France, read this: http://circulaire.legifrance.gouv.fr/pdf/2012/01/cir_34487.pdf This Odoo module implements VAT Pro Rata with *clé de répartition unique*, as explained in section 1.2.4 of the instruction n° 12-002-M0 of January 19th 2012.
 
+Upgrade notes
+-------------
+
+The installation or the update of the module creates indexes on the tables account_move and account_move_line. *CREATE INDEX* locks the writes on the table while the index is built, which can take several minutes on a large ledger. To avoid it, create the indexes before the update with the following SQL queries, which don't lock the writes (the update skips the indexes that already exist)::
+
+  CREATE INDEX CONCURRENTLY IF NOT EXISTS account_move_vat_prorata_idx ON account_move (journal_id, date, company_id);
+  CREATE INDEX CONCURRENTLY IF NOT EXISTS account_move_line_vat_prorata_idx ON account_move_line (journal_id, date, company_id) INCLUDE (account_id, parent_state, debit, credit, balance);
+
+(remove the INCLUDE clause with PostgreSQL < 11). The partial index account_move_line_vat_prorata_kind_idx is on a column added by the module, so it can't be created before: it is empty at the installation, but building it still reads the whole table once while the writes are locked.
+
 This module has been written by Alexis de Lattre from Akretion
 <alexis.delattre@akretion.com>.
     """,
@@ -26,8 +36,10 @@ This module has been written by Alexis de Lattre from Akretion
         'security/ir.model.access.csv',
         'security/rule.xml',
         'data/decimal_precision_data.xml',
+        'data/ir_cron.xml',
         'views/account_account.xml',
         'views/res_config_settings.xml',
+        'views/account_vat_prorata_simulation.xml',
         'views/account_vat_prorata.xml',
     ],
     'installable': True,
@@ -0,0 +1,20 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # move_id is now computed from the one2many move_ids
+    cr.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'account_vat_prorata' AND column_name = 'move_id'
+        """)
+    if cr.fetchone():
+        cr.execute("""
+            UPDATE account_move am
+            SET vat_prorata_id = avp.id
+            FROM account_vat_prorata avp
+            WHERE avp.move_id = am.id
+            """)
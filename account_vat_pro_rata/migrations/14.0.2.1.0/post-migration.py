@@ -0,0 +1,15 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import SUPERUSER_ID, api
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # the form shows the summary by account of the lines
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    proratas = env['account.vat.prorata'].search([('state', '=', 'done')])
+    if proratas:
+        proratas._refresh_line_summary()
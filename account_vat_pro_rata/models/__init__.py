@@ -1,4 +1,8 @@
 from . import res_company
 from . import account_account
+from . import account_tax
+from . import account_move
 from . import account_vat_prorata
+from . import account_vat_prorata_aggregate
+from . import account_vat_prorata_job
 from . import l10n_fr_account_vat_return
@@ -2,7 +2,7 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class AccountAccount(models.Model):
@@ -19,3 +19,50 @@ class AccountAccount(models.Model):
         "(including revenue accounts used for the activity suject to VAT "
         "which is excluded from VAT because the fiscal position is Export or "
         "Intra-EU B2B)")
+
+    def init(self):
+        super().init()
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_account_vat_subject_idx
+            ON account_account (vat_subject)
+            WHERE vat_subject IS NOT NULL
+            """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env['account.vat.prorata'].clear_caches()
+        if 'vat_subject' in vals:
+            # the VAT pro rata aggregate must be rebuilt
+            self.mapped('company_id').write(
+                {'vat_prorata_aggregate_watermark': False})
+        if 'user_type_id' in vals:
+            # the journal items of the accounts whose internal type
+            # changes must be classified again for the VAT pro rata
+            new_type = self.env['account.account.type'].browse(
+                vals['user_type_id']).type
+            self.filtered(lambda x: x.internal_type != new_type).mapped(
+                'company_id').write({'vat_prorata_kind_signature': False})
+        return super().write(vals)
+
+    def unlink(self):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().unlink()
+
+
+class AccountAccountType(models.Model):
+    _inherit = 'account.account.type'
+
+    def write(self, vals):
+        if 'type' in vals:
+            # the internal type of the accounts of this type changes
+            changed = self.filtered(lambda x: x.type != vals['type'])
+            if changed:
+                self.env['account.account'].search(
+                    [('user_type_id', 'in', changed.ids)]).mapped(
+                        'company_id').write(
+                            {'vat_prorata_kind_signature': False})
+        return super().write(vals)
@@ -0,0 +1,257 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    vat_prorata_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', readonly=True,
+        copy=False, ondelete='set null', index=True)
+
+    def init(self):
+        super().init()
+        # for the search of the source moves of the VAT pro rata
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_vat_prorata_idx
+            ON account_move (journal_id, date, company_id)
+            """)
+
+    # The buckets of the VAT pro rata aggregate are marked as dirty
+    # before (old bucket, only if the bucket changes) and after (new bucket
+    # or new state) the write
+    def write(self, vals):
+        avpao = self.env['account.vat.prorata.aggregate']
+        move_bucket = any(
+            key in vals for key in ('date', 'journal_id', 'company_id'))
+        if move_bucket:
+            avpao._mark_dirty(self.ids)
+        res = super().write(vals)
+        if move_bucket or 'state' in vals:
+            avpao._mark_dirty(self.ids)
+        return res
+
+    def unlink(self):
+        self.env['account.vat.prorata.aggregate']._mark_dirty(self.ids)
+        return super().unlink()
+
+    def _post(self, soft=True):
+        posted = super()._post(soft=soft)
+        aamlo = self.env['account.move.line']
+        for company in posted.mapped('company_id'):
+            # the classification is only done at posting time if the
+            # company configuration didn't change since the last
+            # classification, otherwise it is done in batch at the next
+            # generation of the VAT pro rata lines
+            if not company.vat_prorata or \
+                    not company.vat_prorata_kind_signature:
+                continue
+            try:
+                tax_map = self.env['account.vat.prorata']._get_prorata_tax_map(
+                    company.id)
+            except UserError:
+                continue
+            if aamlo._vat_prorata_kind_signature(tax_map) == \
+                    company.vat_prorata_kind_signature:
+                aamlo._vat_prorata_classify(
+                    company.id, tax_map,
+                    move_ids=posted.filtered(
+                        lambda x: x.company_id == company).ids)
+        return posted
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    # Classification of the journal item for the VAT pro rata,
+    # set by _vat_prorata_classify() ; empty = not classified yet
+    vat_prorata_kind = fields.Selection([
+        ('vat', 'Deductible VAT'),
+        ('other_tax', 'Expense with VAT'),
+        ('other_notax', 'Expense without VAT'),
+        ('none', 'None'),
+        ], string='VAT Pro Rata Classification', readonly=True, copy=False)
+    vat_prorata_rate = fields.Float(
+        string='VAT Pro Rata Rate', readonly=True, copy=False)
+
+    def init(self):
+        super().init()
+        # The indexes are created at the installation/update of the module,
+        # which locks the writes on the table: cf the upgrade notes in the
+        # description of the module to create them CONCURRENTLY before.
+        # For the selection of the journal items of the VAT pro rata
+        # cf account.vat.prorata _get_classification_query()
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_line_vat_prorata_kind_idx
+            ON account_move_line (move_id)
+            WHERE vat_prorata_kind IN ('vat', 'other_tax', 'other_notax')
+            """)
+        # for the VAT pro rata ratio query
+        # cf account.vat.prorata _get_ratio_rows_query()
+        include = ''
+        if self._cr.connection.server_version >= 110000:
+            # covering index => index-only scan
+            include = (
+                ' INCLUDE (account_id, parent_state, debit, credit, balance)')
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_line_vat_prorata_idx
+            ON account_move_line (journal_id, date, company_id)
+            """ + include)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        self.env['account.vat.prorata.aggregate']._mark_dirty_lines(lines)
+        return lines
+
+    def write(self, vals):
+        avpao = self.env['account.vat.prorata.aggregate']
+        dirty = any(key in vals for key in (
+            'account_id', 'move_id', 'debit', 'credit', 'balance'))
+        if dirty:
+            avpao._mark_dirty_lines(self)
+        if 'account_id' in vals or 'tax_ids' in vals:
+            # will be classified again
+            vals = dict(vals, vat_prorata_kind=False)
+        res = super().write(vals)
+        if dirty:
+            avpao._mark_dirty_lines(self)
+        return res
+
+    def unlink(self):
+        self.env['account.vat.prorata.aggregate']._mark_dirty_lines(self)
+        return super().unlink()
+
+    @api.model
+    def _vat_prorata_kind_signature(self, tax_map):
+        # the order of the VAT taxes is the order of account.tax,
+        # i.e. 'sequence, id', used to get the first tax of the lines.
+        # The internal types of the accounts are not in the signature:
+        # a new account has no journal items and a change of the
+        # internal type of an account resets the signature,
+        # cf account.account write()
+        key = (
+            sorted(tax_map['vat_deduc_account_ids']),
+            list(tax_map['vattax2rate'].items()),
+            )
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    @api.model
+    def _vat_prorata_classification_cte(self, where):
+        """Return the SQL of the CTEs 'first_tax' and 'classified'
+        (line_id, move_id, balance, kind, vat_rate) that classify the journal items
+        selected by where, cf _vat_prorata_classify(). Parameters:
+        vat_account_ids, vat_tax_ids and the ones of where."""
+        # line.tax_ids[0] is the first active tax in the order of
+        # account.tax i.e. 'sequence, id'
+        return """
+            first_tax AS (
+                SELECT DISTINCT ON (rel.account_move_line_id)
+                    rel.account_move_line_id AS line_id,
+                    rel.account_tax_id AS tax_id,
+                    at.amount AS amount
+                FROM account_move_line_account_tax_rel rel
+                JOIN account_tax at ON at.id = rel.account_tax_id
+                JOIN account_move_line aml
+                    ON aml.id = rel.account_move_line_id
+                WHERE """ + where + """
+                -- like line.tax_ids, ignore the archived taxes
+                AND at.active
+                ORDER BY rel.account_move_line_id, at.sequence, at.id
+            ), classified AS (
+                SELECT
+                    aml.id AS line_id,
+                    aml.move_id AS move_id,
+                    aml.balance AS balance,
+                    CASE
+                        WHEN aml.account_id = ANY(%(vat_account_ids)s)
+                            THEN 'vat'
+                        WHEN aa.internal_type = 'other'
+                            AND ft.tax_id = ANY(%(vat_tax_ids)s)
+                            THEN 'other_tax'
+                        WHEN aa.internal_type = 'other'
+                            THEN 'other_notax'
+                        ELSE 'none'
+                    END AS kind,
+                    CASE
+                        WHEN aml.account_id = ANY(%(vat_account_ids)s)
+                            THEN NULL
+                        WHEN aa.internal_type = 'other'
+                            AND ft.tax_id = ANY(%(vat_tax_ids)s)
+                            THEN ft.amount
+                        WHEN aa.internal_type = 'other'
+                            THEN 100
+                    END AS vat_rate
+                FROM account_move_line aml
+                JOIN account_account aa ON aa.id = aml.account_id
+                LEFT JOIN first_tax ft ON ft.line_id = aml.id
+                WHERE """ + where + """
+            )"""
+
+    @api.model
+    def _vat_prorata_classification_flush(self):
+        self.flush([
+            'move_id', 'account_id', 'company_id', 'tax_ids',
+            'vat_prorata_kind'])
+        self.env['account.tax'].flush(['sequence', 'amount', 'active'])
+        self.env['account.account'].flush(['internal_type'])
+
+    @api.model
+    def _vat_prorata_classify(
+            self, company_id, tax_map, move_ids=None, only_missing=False):
+        """Store the classification of the journal items of the company
+        (or of the journal entries move_ids) with a single query:
+        'vat' for deductible VAT, 'other_tax' for an expense whose first
+        tax is a VAT tax (vat_prorata_rate = rate of the tax), 'other_notax'
+        for other expenses (vat_prorata_rate = 100) and 'none'."""
+        if move_ids is not None and not move_ids:
+            return
+        self._vat_prorata_classification_flush()
+        where = 'aml.company_id = %(company_id)s'
+        if move_ids is not None:
+            where += ' AND aml.move_id IN %(move_ids)s'
+        if only_missing:
+            where += ' AND aml.vat_prorata_kind IS NULL'
+        self._cr.execute(
+            "WITH " + self._vat_prorata_classification_cte(where) + """
+            UPDATE account_move_line aml
+            SET vat_prorata_kind = c.kind, vat_prorata_rate = c.vat_rate
+            FROM classified c
+            WHERE c.line_id = aml.id
+            AND (
+                aml.vat_prorata_kind IS DISTINCT FROM c.kind OR
+                aml.vat_prorata_rate IS DISTINCT FROM c.vat_rate)
+            """, {
+                'company_id': company_id,
+                'move_ids': tuple(move_ids or []),
+                'vat_account_ids': list(tax_map['vat_deduc_account_ids']),
+                'vat_tax_ids': list(tax_map['vattax2rate']),
+                })
+        logger.debug(
+            'VAT prorata: %d journal items classified in company ID %d',
+            self._cr.rowcount, company_id)
+        self.invalidate_cache(['vat_prorata_kind', 'vat_prorata_rate'])
+
+    @api.model
+    def _vat_prorata_refresh_kind(self, company, tax_map, move_ids):
+        """Classify all the journal items of the company when the
+        configuration changed since the last classification, otherwise
+        only the journal items of move_ids that are not classified yet
+        (draft entries, modified journal items)"""
+        signature = self._vat_prorata_kind_signature(tax_map)
+        if company.vat_prorata_kind_signature != signature:
+            logger.info(
+                'VAT prorata: classification of all the journal items of '
+                'company %s', company.display_name)
+            self._vat_prorata_classify(company.id, tax_map)
+            company.write({'vat_prorata_kind_signature': signature})
+        else:
+            self._vat_prorata_classify(
+                company.id, tax_map, move_ids=move_ids, only_missing=True)
@@ -0,0 +1,45 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+
+class AccountTax(models.Model):
+    _inherit = 'account.tax'
+
+    # Clear the cache of the prorata tax map
+    # cf account.vat.prorata _get_prorata_tax_map()
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env['account.vat.prorata'].clear_caches()
+        if 'sequence' in vals or 'active' in vals:
+            # the first tax of the journal items may change
+            self.mapped('company_id').write(
+                {'vat_prorata_kind_signature': False})
+        return super().write(vals)
+
+    def unlink(self):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().unlink()
+
+
+class AccountTaxRepartitionLine(models.Model):
+    _inherit = 'account.tax.repartition.line'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env['account.vat.prorata'].clear_caches()
+        return super().unlink()
@@ -2,15 +2,42 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import fields, models, api, _
-from odoo.tools import float_is_zero, float_round
+from odoo import fields, models, api, tools, _
+from odoo.tools import float_is_zero, float_round, config
 from odoo.exceptions import UserError, ValidationError
 from dateutil.relativedelta import relativedelta
 from odoo.tools.misc import format_date
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from array import array
+import base64
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
 import logging
 logger = logging.getLogger(__name__)
 
+try:
+    import xlsxwriter
+except ImportError:
+    logger.debug('Cannot import xlsxwriter')
+    xlsxwriter = None
+
+# classification of the journal items
+PRORATA_KINDS = ('vat', 'other_tax', 'other_notax')
+# maximum number of threads of the cron that computes the VAT pro rata
+# records in parallel (one database connection each)
+PARALLEL_MAX_WORKERS = 4
+# default number of source moves processed at once by the generation
+MOVE_CHUNK_SIZE = 1000
+# block size to copy the audit files to the filestore
+AUDIT_BLOCK_SIZE = 1024 * 1024
+
 
 class AccountVatProrata(models.Model):
     _name = 'account.vat.prorata'
@@ -71,18 +98,57 @@ class AccountVatProrata(models.Model):
         'account.journal', string='VAT Pro Rata Journal', required=True,
         domain="[('company_id', '=', company_id), ('type', '=', 'general')]",
         states={'done': [('readonly', True)]}, check_company=True)
+    move_ids = fields.One2many(
+        'account.move', 'vat_prorata_id', string='VAT Pro Rata Entries',
+        readonly=True)
+    # kept for compatibility: first VAT pro rata entry
     move_id = fields.Many2one(
-        'account.move', string='VAT Pro Rata Entry', readonly=True,
-        copy=False, check_company=True)
+        'account.move', string='VAT Pro Rata Entry',
+        compute='_compute_move_id')
+    move_split = fields.Selection([
+        ('none', 'Single Journal Entry'),
+        ('month', 'One Journal Entry per Month'),
+        ('lines', 'Maximum Number of Lines per Journal Entry'),
+        ], string='Split VAT Pro Rata Entry', default='none', required=True,
+        states={'done': [('readonly', True)]},
+        help="For long periods, the VAT Pro Rata Entry can be split "
+        "in one journal entry per month of the source journal items, or in "
+        "several journal entries that each have a maximum number of lines. "
+        "In both cases, each journal entry is balanced.")
+    move_split_max_lines = fields.Integer(
+        string='Maximum Lines per Journal Entry', default=1000,
+        states={'done': [('readonly', True)]})
     move_label = fields.Char(
         string='Label of the VAT Pro Rata Entry', required=True,
         states={'done': [('readonly', True)]},
         help="This label will be written in the 'Name' field of the "
         "VAT Pro Rata Journal Items and in the 'Reference' field of "
         "the Journal Entry.")
+    consolidation = fields.Boolean(
+        string='Annual Consolidation', readonly=True,
+        states={'draft': [('readonly', False)]},
+        help="If enabled, the ratio and the VAT pro rata lines are "
+        "computed from the VAT pro rata records of the periods of the year "
+        "(which must be done and cover the whole period without overlap) "
+        "instead of reading the journal items again: the ratio is "
+        "computed from their subject lines and the VAT pro rata lines are "
+        "their lines reweighted with the ratio of this record.")
+    consolidated_prorata_ids = fields.Many2many(
+        'account.vat.prorata', compute='_compute_consolidated_prorata_ids',
+        string='Consolidated VAT Pro Rata')
     line_ids = fields.One2many(
         'account.vat.prorata.line', 'parent_id', string='VAT Pro Rata Lines',
         readonly=True)
+    # the form shows the summary by account instead of the lines
+    anomaly_ids = fields.One2many(
+        'account.vat.prorata.anomaly', 'parent_id',
+        string='Journal Entries with Anomalies', readonly=True)
+    anomaly_count = fields.Integer(compute='_compute_anomaly_count')
+    line_count = fields.Integer(
+        string='Number of VAT Pro Rata Lines', readonly=True, copy=False)
+    line_summary_ids = fields.One2many(
+        'account.vat.prorata.line.summary', 'parent_id',
+        string='VAT Pro Rata Lines by Account', readonly=True)
     subject_line_ids = fields.One2many(
         'account.vat.prorata.subject.line', 'parent_id',
         domain=[('vat_subject', '=', 'vat_subject')],
@@ -108,6 +174,94 @@ class AccountVatProrata(models.Model):
         ('done', 'Done'),
         ], string='State', index=True, readonly=True,
         tracking=True, default='draft', copy=False)
+    # Used to regenerate only the lines of the moves modified since
+    # the last generation of the VAT pro rata lines
+    prorata_watermark = fields.Datetime(
+        string='Last Generation of Lines', readonly=True, copy=False)
+    prorata_signature = fields.Char(readonly=True, copy=False)
+    job_ids = fields.One2many(
+        'account.vat.prorata.job', 'prorata_id', string='Background Jobs',
+        readonly=True)
+    job_state = fields.Selection(
+        related='job_ids.state', string='Background Job Status')
+    job_progress = fields.Float(
+        related='job_ids.progress', string='Background Job Progress (%)')
+    stat_ids = fields.One2many(
+        'account.vat.prorata.stat', 'parent_id',
+        string='Performance Statistics', readonly=True)
+
+    @api.depends('move_ids')
+    def _compute_move_id(self):
+        for rec in self:
+            rec.move_id = rec.move_ids[:1]
+
+    @api.depends('anomaly_ids')
+    def _compute_anomaly_count(self):
+        rg_res = self.env['account.vat.prorata.anomaly'].read_group(
+            [('parent_id', 'in', self.ids)], ['parent_id'], ['parent_id'])
+        mapped_data = {
+            x['parent_id'][0]: x['parent_id_count'] for x in rg_res}
+        for rec in self:
+            rec.anomaly_count = mapped_data.get(rec.id, 0)
+
+    @api.depends('consolidation', 'date_from', 'date_to', 'company_id')
+    def _compute_consolidated_prorata_ids(self):
+        for rec in self:
+            periods = self.browse()
+            if rec.consolidation and rec.date_from and rec.date_to:
+                periods = rec._get_consolidated_proratas()
+            rec.consolidated_prorata_ids = periods
+
+    def _get_consolidated_proratas(self):
+        self.ensure_one()
+        return self.search([
+            ('company_id', '=', self.company_id.id),
+            ('date_from', '>=', self.date_from),
+            ('date_to', '<=', self.date_to),
+            ('consolidation', '=', False),
+            ('id', '!=', self._origin.id),
+            ], order='date_from, date_to')
+
+    def _check_consolidated_proratas(self):
+        """Return the VAT pro rata records of the periods, after checking
+        that they can be consolidated"""
+        self.ensure_one()
+        periods = self._get_consolidated_proratas()
+        if not periods:
+            raise UserError(_(
+                "There are no VAT pro rata records to consolidate between "
+                "{date_from} and {date_to}.").format(
+                    date_from=format_date(self.env, self.date_from),
+                    date_to=format_date(self.env, self.date_to)))
+        next_date = self.date_from
+        for period in periods:
+            if period.date_from != next_date:
+                raise UserError(_(
+                    "The VAT pro rata records to consolidate must cover "
+                    "the period without gap nor overlap, but "
+                    "'{prorata}' doesn't start on {date}.").format(
+                        prorata=period.display_name,
+                        date=format_date(self.env, next_date)))
+            if period.state != 'done':
+                raise UserError(_(
+                    "The VAT pro rata '%s' must be done before "
+                    "the consolidation.") % period.display_name)
+            if (
+                    period.target_move != self.target_move or
+                    period.source_journal_ids != self.source_journal_ids or
+                    period.ratio_source_journal_ids !=
+                    self.ratio_source_journal_ids):
+                raise UserError(_(
+                    "The VAT pro rata '%s' doesn't have the same target "
+                    "moves and source journals as the consolidation.")
+                    % period.display_name)
+            next_date = period.date_to + relativedelta(days=1)
+        if next_date != self.date_to + relativedelta(days=1):
+            raise UserError(_(
+                "The VAT pro rata records to consolidate don't cover "
+                "the period up to {date}.").format(
+                    date=format_date(self.env, self.date_to)))
+        return periods
 
     _sql_constraints = [(
         'date_company_uniq',
@@ -125,96 +279,297 @@ class AccountVatProrata(models.Model):
                         date_to=format_date(self.env, rec.date_to),
                         date_from=format_date(self.env, rec.date_from)))
 
+    def _check_no_job_in_progress(self):
+        job_id = self._context.get('vat_prorata_job_id')
+        for rec in self:
+            jobs = rec.job_ids.filtered(
+                lambda x: x.state in ('queued', 'running') and x.id != job_id)
+            if jobs:
+                dead_ids = jobs._fail_dead_jobs()
+                jobs = jobs.filtered(lambda x: x.id not in dead_ids)
+            if jobs:
+                raise UserError(_(
+                    "A background computation is in progress on %s. "
+                    "Wait for it to finish or cancel it.") % rec.display_name)
+
+    def button_compute_ratio_async(self):
+        self._check_no_job_in_progress()
+        self.env['account.vat.prorata.job']._enqueue(self, 'compute_ratio')
+
+    def button_generate_move_async(self):
+        self._check_no_job_in_progress()
+        self.env['account.vat.prorata.job']._enqueue(self, 'generate_move')
+
     def button_back2draft(self):
-        self.ensure_one()
-        self.write({'state': 'draft'})
-        self.delete_all_lines()
-        if self.move_id:
-            self.move_id.unlink()
+        self._check_no_job_in_progress()
+        self.write({'state': 'draft', 'line_count': 0})
+        # VAT pro rata lines and watermark are kept: they will be updated
+        # incrementally by the next generation. The results of the
+        # previous run shown on the form are deleted.
+        self.delete_subject_lines()
+        self._sql_delete_children('account.vat.prorata.line.summary')
+        self._sql_delete_children('account.vat.prorata.anomaly')
+        moves = self.move_ids
+        if moves:
+            self._bulk_unlink_moves(moves)
 
-    def delete_all_lines(self):
-        self.ensure_one()
-        avplo = self.env['account.vat.prorata.line']
-        avpslo = self.env['account.vat.prorata.subject.line']
-        lines = avplo.search([('parent_id', '=', self.id)])
-        if lines:
-            lines.unlink()
-        subject_lines = avpslo.search([('parent_id', '=', self.id)])
-        if subject_lines:
-            subject_lines.unlink()
+    def _sql_delete_children(self, model_name, ids=None):
+        """Delete the lines of the VAT pro rata records (or the lines of
+        model_name with the given IDs) with a single DELETE query. The lines
+        of VAT pro rata don't have any business logic on unlink."""
+        model = self.env[model_name]
+        model.flush()
+        if ids is not None:
+            if not ids:
+                return
+            self._cr.execute(
+                "DELETE FROM " + model._table + " WHERE id IN %s",
+                (tuple(ids), ))
+        else:
+            if not self:
+                return
+            self._cr.execute(
+                "DELETE FROM " + model._table + " WHERE parent_id IN %s",
+                (tuple(self.ids), ))
+        model.invalidate_cache()
+        self.invalidate_cache(ids=self.ids)
 
-    def button_compute_ratio(self):
-        self.ensure_one()
-        avpslo = self.env['account.vat.prorata.subject.line']
-        if not self.company_id.vat_prorata:
+    @api.model
+    def _bulk_unlink_moves(self, moves):
+        """Delete the journal items of the VAT pro rata entries with a single
+        query, then the journal entries via the ORM. The checks of the ORM
+        (lock date, entry posted once) are done before the DELETE query,
+        and the journal items must not have reconciliations nor analytic
+        lines, which would be deleted silently by the foreign keys."""
+        moves._check_fiscalyear_lock_date()
+        if not self._context.get('force_delete'):
+            posted = moves.filtered(
+                lambda x: x.state == 'posted' or x.posted_before)
+            if posted:
+                raise UserError(_(
+                    "You cannot delete the journal entry '%s' which has "
+                    "been posted once.") % posted[0].display_name)
+        self.env['account.move.line'].flush()
+        self.env['account.partial.reconcile'].flush()
+        self.env['account.analytic.line'].flush(['move_id'])
+        self._cr.execute("""
+            SELECT aml.move_id
+            FROM account_move_line aml
+            WHERE aml.move_id IN %(move_ids)s
+            AND (
+                EXISTS (
+                    SELECT 1 FROM account_partial_reconcile apr
+                    WHERE apr.debit_move_id = aml.id
+                    OR apr.credit_move_id = aml.id) OR
+                EXISTS (
+                    SELECT 1 FROM account_analytic_line aal
+                    WHERE aal.move_id = aml.id))
+            LIMIT 1
+            """, {'move_ids': tuple(moves.ids)})
+        row = self._cr.fetchone()
+        if row:
             raise UserError(_(
-                "Company '%s' doesn't have VAT Prorata.")
-                % self.company_id.display_name)
-        self.delete_all_lines()
-        ccur = self.company_id.currency_id
-        target_move_sql = ' '
-        if self.target_move == 'posted':
-            target_move_sql = " AND am.state = 'posted' "
+                "The journal entry '%s' has reconciled journal items or "
+                "analytic lines: it cannot be deleted.") %
+                self.env['account.move'].browse(row[0]).display_name)
+        # the unlink() of the journal items is bypassed
+        self.env['account.vat.prorata.aggregate']._mark_dirty(moves.ids)
+        self._cr.execute(
+            "DELETE FROM account_move_line WHERE move_id IN %s",
+            (tuple(moves.ids), ))
+        self.env['account.move.line'].invalidate_cache()
+        moves.invalidate_cache()
+        moves.unlink()
+
+    def delete_subject_lines(self):
+        self._sql_delete_children('account.vat.prorata.subject.line')
+
+    @contextmanager
+    def _track_phase(self, stats, phase):
+        """Measure the wall time and the number of SQL queries of a phase.
+        The caller can set the number of rows processed in the yielded dict.
+        Measures are added to stats (key = phase), so that a phase run on
+        several chunks is recorded once."""
+        cr = self._cr
+        tracker = {'rows': 0}
+        start = time.perf_counter()
+        query_count_start = cr.sql_log_count
+        try:
+            yield tracker
+        finally:
+            stat = stats.setdefault(phase, {
+                'duration': 0.0, 'query_count': 0, 'rows': 0})
+            stat['duration'] += time.perf_counter() - start
+            stat['query_count'] += cr.sql_log_count - query_count_start
+            stat['rows'] += tracker['rows']
+
+    def _save_phase_stats(self, stats):
+        vals_list = []
+        for rec in self:
+            for phase, stat in stats.items():
+                vals_list.append(dict(stat, parent_id=rec.id, phase=phase))
+                rec._log_phase_stat(phase, stat)
+        self.env['account.vat.prorata.stat'].create(vals_list)
+
+    def _log_phase_stat(self, phase, stat):
+        """Hook for metrics collection"""
+        logger.info(
+            'VAT prorata ID %d company %s phase %s: %.3f s, %d queries, '
+            '%d rows', self.id, self.company_id.id, phase, stat['duration'],
+            stat['query_count'], stat['rows'])
+
+    def _get_ratio_rows_query(self):
+        # Uses the columns of account_move_line that are denormalized from
+        # account_move (journal_id, date, company_id, parent_state) so that
+        # PostgreSQL can use the index account_move_line_vat_prorata_idx
+        # without joining account_move
         request = """
             SELECT
+                avp.id AS prorata_id,
                 aml.account_id AS account_id,
                 aa.vat_subject AS vat_subject,
                 SUM(aml.debit) AS debit,
                 SUM(aml.credit) AS credit,
                 SUM(aml.balance) AS balance
-                FROM account_move_line aml
-                LEFT JOIN account_move am ON aml.move_id = am.id
-                LEFT JOIN account_account aa ON aa.id = aml.account_id
-                WHERE aa.vat_subject in ('vat_subject', 'no_vat_subject')
-                AND am.company_id = %s
-                AND am.date >= %s
-                AND am.date <= %s
-                AND am.journal_id in %s
-            """ + target_move_sql + \
+                FROM account_vat_prorata avp
+                JOIN account_vat_prorata_ratio_journal_rel rjrel
+                    ON rjrel.vat_prorata_id = avp.id
+                JOIN account_move_line aml
+                    ON aml.journal_id = rjrel.journal_id
+                    AND aml.date >= avp.date_from
+                    AND aml.date <= avp.date_to
+                    AND aml.company_id = avp.company_id
+                    AND (
+                        avp.target_move != 'posted' OR
+                        aml.parent_state = 'posted')
+                JOIN account_account aa ON aa.id = aml.account_id
+                    AND aa.vat_subject IN ('vat_subject', 'no_vat_subject')
+                WHERE avp.id IN %s
+                GROUP BY avp.id, aml.account_id, aa.code, aa.vat_subject
+                ORDER BY avp.id, aa.code
             """
-                GROUP BY aml.account_id, aa.code, aa.vat_subject
+        return request, (tuple(self.ids), )
+
+    def _get_ratio_rows_consolidation_query(self, periods):
+        """Same as _get_ratio_rows_query(), but reads the subject lines of
+        the VAT pro rata records of the periods"""
+        self.ensure_one()
+        request = """
+            SELECT
+                %s AS prorata_id,
+                avpsl.account_id AS account_id,
+                avpsl.vat_subject AS vat_subject,
+                SUM(avpsl.debit) AS debit,
+                SUM(avpsl.credit) AS credit,
+                SUM(avpsl.balance) AS balance
+                FROM account_vat_prorata_subject_line avpsl
+                JOIN account_account aa ON aa.id = avpsl.account_id
+                WHERE avpsl.parent_id IN %s
+                GROUP BY avpsl.account_id, aa.code, avpsl.vat_subject
                 ORDER BY aa.code
             """
-        self._cr.execute(
-            request,
-            (self.company_id.id, self.date_from, self.date_to,
-             tuple(self.ratio_source_journal_ids.ids)))
-        total = 0.0
-        vat_subject_total = 0.0
-        for row in self._cr.dictfetchall():
-            # print "row=", row
-            if ccur.is_zero(row['credit']) and ccur.is_zero(row['debit']):
-                continue
-            total += row['balance']
-            if row['vat_subject'] == 'vat_subject':
-                vat_subject_total += row['balance']
-            vals = {
-                'parent_id': self.id,
-                'account_id': row['account_id'],
-                'vat_subject': row['vat_subject'],
-                'credit': row['credit'],
-                'debit': row['debit'],
-                'balance': row['balance'],
-                }
-            avpslo.create(vals)
+        return request, (self.id, tuple(periods.ids))
 
-        perct = 0.0
+    def _insert_subject_lines(self, request, params):
+        """Create the subject lines from the rows of the ratio query
+        (request, params) with a single INSERT ... SELECT, skipping the
+        accounts with debit and credit equal to zero in the currency of
+        the company. Return a dict with key = VAT pro rata ID and
+        value = tuple (total, VAT subject total, number of lines)"""
+        self._cr.execute("""
+            WITH ratio_rows AS (""" + request + """
+            ), inserted AS (
+                INSERT INTO account_vat_prorata_subject_line (
+                    parent_id, account_id, vat_subject, credit, debit,
+                    balance, create_uid, create_date, write_uid, write_date)
+                SELECT
+                    r.prorata_id, r.account_id, r.vat_subject, r.credit,
+                    r.debit, r.balance, %s, now() at time zone 'UTC',
+                    %s, now() at time zone 'UTC'
+                FROM ratio_rows r
+                JOIN account_vat_prorata avp ON avp.id = r.prorata_id
+                JOIN res_company rc ON rc.id = avp.company_id
+                JOIN res_currency cur ON cur.id = rc.currency_id
+                -- same as ccur.is_zero()
+                WHERE ROUND(r.credit / cur.rounding) != 0
+                OR ROUND(r.debit / cur.rounding) != 0
+                RETURNING parent_id, vat_subject, balance
+            )
+            SELECT
+                parent_id,
+                SUM(balance),
+                SUM(CASE WHEN vat_subject = 'vat_subject'
+                    THEN balance ELSE 0 END),
+                COUNT(*)
+            FROM inserted
+            GROUP BY parent_id
+            """, tuple(params) + (self._uid, self._uid))
+        res = {}
+        for (prorata_id, total, vat_subject_total, count) in \
+                self._cr.fetchall():
+            res[prorata_id] = (total, vat_subject_total, count)
+        self.env['account.vat.prorata.subject.line'].invalidate_cache()
+        self.invalidate_cache(['subject_line_ids', 'nosubject_line_ids'])
+        return res
+
+    def button_compute_ratio(self):
+        if not self:
+            return
+        self._check_no_job_in_progress()
+        for rec in self:
+            if not rec.company_id.vat_prorata:
+                raise UserError(_(
+                    "Company '%s' doesn't have VAT Prorata.")
+                    % rec.company_id.display_name)
+        self.delete_subject_lines()
         perct_prec = self.env['decimal.precision'].precision_get(
             'VAT Pro Rata Ratio')
-        if total:
-            perct = float_round(
-                100 * vat_subject_total / total, precision_digits=perct_prec)
+        # the ratio query is shared by all the records, so its stats
+        # are recorded on each of them
+        stats = {}
+        with self._track_phase(stats, 'subject_lines') as tracker:
+            consolidation_recs = self.filtered('consolidation')
+            consolidation_queries = [
+                rec._get_ratio_rows_consolidation_query(
+                    rec._check_consolidated_proratas())
+                for rec in consolidation_recs]
+            prorata2totals = {}
+            self.flush()
+            self.env['account.move.line'].flush([
+                'journal_id', 'date', 'company_id', 'parent_state',
+                'account_id', 'debit', 'credit', 'balance'])
+            # the official ratio is always computed from the journal
+            # items, the aggregate is only used for the provisional ratio
+            other_recs = self - consolidation_recs
+            if other_recs:
+                prorata2totals.update(other_recs._insert_subject_lines(
+                    *other_recs._get_ratio_rows_query()))
+            for request, params in consolidation_queries:
+                prorata2totals.update(
+                    self._insert_subject_lines(request, params))
+            tracker['rows'] = sum(
+                totals[2] for totals in prorata2totals.values())
+        for rec in self:
+            total, vat_subject_total, count = prorata2totals.get(
+                rec.id, (0.0, 0.0, 0))
+            perct = 0.0
+            if total:
+                perct = float_round(
+                    100 * vat_subject_total / total,
+                    precision_digits=perct_prec)
 
-        self.write({
-            'state': 'ratio',
-            'computed_perct': perct,
-            'used_perct': perct,
-            })
+            rec.write({
+                'state': 'ratio',
+                'computed_perct': perct,
+                'used_perct': perct,
+                })
+        self._save_phase_stats(stats)
 
-    def _get_vat_deduc_accounts(self):
+    @api.model
+    def _compute_vat_deduc_accounts(self, company):
         vat_deduc_accounts = self.env['account.account']
         deduc_vat_taxes = self.env['account.tax'].search([
-            ('company_id', '=', self.company_id.id),
+            ('company_id', '=', company.id),
             ("amount_type", "=", "percent"),
             ("amount", ">", 0),
             ("type_tax_use", "=", "purchase"),
@@ -248,68 +603,131 @@ class AccountVatProrata(models.Model):
         logger.debug('vat_deduc_accounts=%s', [acc.code for acc in vat_deduc_accounts])
         return vat_deduc_accounts
 
-    def generate_prorata_lines(self):
-        avplo = self.env['account.vat.prorata.line']
-        amo = self.env['account.move']
-        aao = self.env['account.account']
-        ato = self.env['account.tax']
-        company = self.company_id
-        # delete existing prorata lines
-        lines = avplo.search([('parent_id', '=', self.id)])
-        if lines:
-            lines.unlink()
-        # Prepare datas
-        ccur = company.currency_id
-
-        vat_deduc_accounts = self._get_vat_deduc_accounts()
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_prorata_tax_map(self, company_id):
+        """Return a dict with the deductible VAT account IDs, the VAT rate
+        by purchase tax ID and the internal type by account ID.
+        The result is cached per company ; the cache is cleared when a tax,
+        a tax repartition line or an account is modified.
+        The returned dict is shared: it must not be modified."""
+        company = self.env['res.company'].browse(company_id)
+        vat_deduc_accounts = self._compute_vat_deduc_accounts(company)
         speed_acc2type = {}  # key = account_id, value = internal type
-        accounts = aao.search_read(
-            [('company_id', '=', company.id)], ['internal_type'])
+        accounts = self.env['account.account'].search_read(
+            [('company_id', '=', company_id)], ['internal_type'])
         for acc in accounts:
             speed_acc2type[acc['id']] = acc['internal_type']
         speed_vattax2rate = {}
-        vattaxes = ato.search([
-            ('company_id', '=', company.id),
+        vattaxes = self.env['account.tax'].search([
+            ('company_id', '=', company_id),
             ('type_tax_use', '=', 'purchase'),
             ('amount_type', '=', 'percent'),
             ('amount', '>', 0)])
         for vattax in vattaxes:
             if not float_is_zero(vattax.amount, precision_digits=4):
                 speed_vattax2rate[vattax.id] = vattax.amount
-        ratio = (100.0 - self.used_perct) / 100.0
-        # Get moves
+        return {
+            'vat_deduc_account_ids': frozenset(vat_deduc_accounts.ids),
+            'acc2type': speed_acc2type,
+            'vattax2rate': speed_vattax2rate,
+            }
+
+    def _get_vat_deduc_accounts(self):
+        tax_map = self._get_prorata_tax_map(self.company_id.id)
+        return self.env['account.account'].browse(
+            sorted(tax_map['vat_deduc_account_ids']))
+
+    def _prepare_speed_dict(self):
+        self.ensure_one()
+        company = self.company_id
+        tax_map = self._get_prorata_tax_map(company.id)
+        speedy = {
+            'company_id': company.id,
+            'currency': company.currency_id,
+            'vat_deduc_account_ids': tax_map['vat_deduc_account_ids'],
+            'acc2type': tax_map['acc2type'],
+            'vattax2rate': tax_map['vattax2rate'],
+            'ratio': (100.0 - self.used_perct) / 100.0,
+            }
+        return speedy
+
+    def _get_prorata_move_domain(self):
+        self.ensure_one()
         domain = [
             ('journal_id', 'in', self.source_journal_ids.ids),
             ('date', '>=', self.date_from),
             ('date', '<=', self.date_to),
-            ('company_id', '=', company.id),
+            ('company_id', '=', self.company_id.id),
             ('fiscal_position_fr_vat_type', 'in', ('france', False)),
             ]
         if self.target_move == 'posted':
             domain.append(('state', '=', 'posted'))
-        moves = amo.search(domain)
+        return domain
+
+    def _get_prorata_engine(self):
+        self.ensure_one()
+        # the context key allows to run the reference python engine
+        # on a specific computation, for example to compare results
+        return (
+            self._context.get('vat_prorata_engine') or
+            self.company_id.vat_prorata_engine or 'sql')
+
+    @api.model
+    def _prepare_work_move(self, move_id):
+        return {
+            'move_id': move_id,
+            'vat': {},
+            # key = line ID
+            # value = {'bal': balance, 'prorata': balance * ratio}
+            'other_tax': {},
+            # key = line ID
+            # value = {'bal': balance, 'vat_rate': 5.5, 'weight': weight}
+            'other_notax': {},
+            # key = line ID
+            # value = {'bal': balance, 'vat_rate': 100, 'weight': weight}
+            'total_vat': 0.0,
+            'total_weight_other_tax': 0.0,
+            'total_weight_other_notax': 0.0}
+
+    def _check_work_move(self, work_move):
+        if (
+                work_move['vat'] and
+                not work_move['other_tax'] and
+                not work_move['other_notax']):
+            move = self.env['account.move'].browse(work_move['move_id'])
+            raise UserError(_(
+                "Move '%s' is very strange: it has deductible VAT but no "
+                "expense line... shouldn't it be in another journal than "
+                "source journals ? Use the button 'Check Journal Entries' "
+                "to list all the journal entries with anomalies.")
+                % move.display_name)
+
+    def _raise_unsupported_move(self, move_id):
+        move = self.env['account.move'].browse(move_id)
+        raise UserError(_(
+            "The scenario of move '%s' is not supported: the weight of "
+            "its expense lines is zero. Use the button 'Check Journal "
+            "Entries' to list all the journal entries with anomalies.")
+            % move.display_name)
+
+    def _prorata_work_moves_python(self, moves, speedy):
+        """Reference engine: classify the journal items move by move
+        via the ORM"""
+        ccur = speedy['currency']
+        ratio = speedy['ratio']
+        speed_acc2type = speedy['acc2type']
+        speed_vattax2rate = speedy['vattax2rate']
         work_moves = []
         for move in moves:
-            tmp = {
-                'vat': {},
-                # key = line ID
-                # value = {'bal': balance, 'prorata': balance * ratio}
-                'other_tax': {},
-                # key = line ID
-                # value = {'bal': balance, 'vat_rate': 5.5, 'weight': weight}
-                'other_notax': {},
-                # key = line ID
-                # value = {'bal': balance, 'vat_rate': 100, 'weight': weight}
-                'total_vat': 0.0,
-                'total_weight_other_tax': 0.0,
-                'total_weight_other_notax': 0.0}
+            tmp = self._prepare_work_move(move.id)
             # in v14, 'other_notax' is almost not used because we always encode
             # a purchase moves via invoice lines in common scenarios
             for line in move.line_ids:
                 if ccur.is_zero(line.balance):
                     continue
                 # VAT line
-                if line.account_id in vat_deduc_accounts:
+                if line.account_id.id in speedy['vat_deduc_account_ids']:
                     prorata_amt = ccur.round(ratio * line.balance)
                     tmp['vat'][line.id] = {
                         'bal': line.balance,
@@ -337,41 +755,908 @@ class AccountVatProrata(models.Model):
                         'weight': weight,
                         }
                     tmp['total_weight_other_notax'] += weight
-            if tmp['vat'] and not tmp['other_tax'] and not tmp['other_notax']:
-                raise UserError(_(
-                    "Move '%s' is very strange... shouldn't it be in another "
-                    "journal than source journals ?"
-                    " (debug: %s)") % (move.display_name, tmp))
+            self._check_work_move(tmp)
             if tmp['vat']:
-                from pprint import pprint
-                print('move=', move.name)
-                pprint(tmp)
                 work_moves.append(tmp)
-        # Create lines
+        return work_moves
+
+    def _get_classification_query(self, move_ids, speedy, store_kind=True):
+        """Return a tuple (query, params) reading the classified journal
+        items of the moves. With store_kind=False, the journal items are
+        classified by the query itself, without writing anything
+        (used by the simulation)."""
+        aamlo = self.env['account.move.line']
+        params = {
+            'move_ids': tuple(move_ids),
+            'kinds': PRORATA_KINDS,
+            }
+        if store_kind:
+            # the classification of the journal items is stored on the
+            # journal items, cf account.move.line _vat_prorata_classify()
+            aamlo._vat_prorata_refresh_kind(self.company_id, speedy, move_ids)
+            classified = """
+                classified AS (
+                    SELECT
+                        aml.id AS line_id,
+                        aml.move_id AS move_id,
+                        aml.balance AS balance,
+                        aml.vat_prorata_kind AS kind,
+                        aml.vat_prorata_rate AS vat_rate
+                    FROM account_move_line aml
+                    WHERE aml.move_id IN %(move_ids)s
+                    AND aml.vat_prorata_kind IN %(kinds)s
+                )"""
+        else:
+            aamlo._vat_prorata_classification_flush()
+            classified = aamlo._vat_prorata_classification_cte(
+                'aml.company_id = %(company_id)s '
+                'AND aml.move_id IN %(move_ids)s')
+            params.update({
+                'company_id': self.company_id.id,
+                'vat_account_ids': list(speedy['vat_deduc_account_ids']),
+                'vat_tax_ids': list(speedy['vattax2rate']),
+                })
+        aamlo.flush(['move_id', 'balance'])
+        query = """
+            WITH """ + classified + """, with_vat AS (
+                SELECT
+                    c.*,
+                    bool_or(c.kind = 'vat') OVER (PARTITION BY c.move_id)
+                        AS has_vat
+                FROM classified c
+                WHERE c.kind IN %(kinds)s
+                AND c.balance != 0
+            )
+            SELECT
+                line_id,
+                move_id,
+                balance,
+                kind,
+                -- float8 like the rate of the python engine
+                vat_rate::float8 AS vat_rate,
+                vat_rate::float8 * balance AS weight
+            FROM with_vat
+            WHERE has_vat
+            ORDER BY move_id, line_id
+            """
+        return query, params
+
+    def _prorata_columns_sql(self, move_ids, speedy, store_kind=True):
+        """SQL engine: classify the journal items of all the moves in
+        a single query. The result is stored in flat arrays (one array per
+        column, one item per journal item) ordered by move and journal
+        item, so the journal items of a move are a contiguous slice.
+        kind is the index in PRORATA_KINDS ; vat_rate, weight and
+        total_weight are 0 for VAT lines.
+        store_kind: cf _get_classification_query()"""
+        columns = {
+            'line_id': array('q'),
+            'move_id': array('q'),
+            'balance': array('d'),
+            'kind': array('b'),
+            'vat_rate': array('d'),
+            'weight': array('d'),
+            'total_weight': array('d'),
+            }
+        if not move_ids:
+            return columns
+        query, params = self._get_classification_query(
+            move_ids, speedy, store_kind=store_kind)
+        kind2code = {kind: code for (code, kind) in enumerate(PRORATA_KINDS)}
+        # server-side cursor: only the arrays are kept in memory
+        for line_id, move_id, balance, kind, vat_rate, weight in \
+                self._iter_cursor_rows(
+                    query, params, 'vat_prorata_classification'):
+            columns['line_id'].append(line_id)
+            columns['move_id'].append(move_id)
+            columns['balance'].append(balance)
+            columns['kind'].append(kind2code[kind])
+            columns['vat_rate'].append(vat_rate or 0.0)
+            columns['weight'].append(weight or 0.0)
+            columns['total_weight'].append(0.0)
+        self._set_columns_total_weight(columns)
+        return columns
+
+    @api.model
+    def _set_columns_total_weight(self, columns):
+        """Set the total weight of the expense lines of each move and
+        kind. The weights are summed in the order of the journal items,
+        like in _prorata_work_moves_python(), and not with a SQL window
+        whose float sum has no defined order, so that the remainder
+        allocated to the last line is the same cent for cent."""
+        kinds = columns['kind']
+        weights = columns['weight']
+        total_weights = columns['total_weight']
+        for start, end in self._iter_column_groups(columns):
+            # VAT lines (kind 0) have no weight
+            kind2total = {}
+            for i in range(start, end):
+                if kinds[i]:
+                    kind2total[kinds[i]] = \
+                        kind2total.get(kinds[i], 0.0) + weights[i]
+            for i in range(start, end):
+                if kinds[i]:
+                    total_weights[i] = kind2total[kinds[i]]
+
+    @api.model
+    def _iter_column_groups(self, columns):
+        """Yield (start, end) of the slice of each move"""
+        move_ids = columns['move_id']
+        size = len(move_ids)
+        start = 0
+        while start < size:
+            end = start + 1
+            while end < size and move_ids[end] == move_ids[start]:
+                end += 1
+            yield start, end
+            start = end
+
+    def _columns_to_work_move(self, columns, start, end, speedy):
+        """Return the classification of a move in the format of the python
+        engine (used to check the moves and for error messages)"""
+        ccur = speedy['currency']
+        ratio = speedy['ratio']
+        tmp = self._prepare_work_move(columns['move_id'][start])
+        for i in range(start, end):
+            kind = PRORATA_KINDS[columns['kind'][i]]
+            balance = columns['balance'][i]
+            if kind == 'vat':
+                prorata_amt = ccur.round(ratio * balance)
+                tmp['vat'][columns['line_id'][i]] = {
+                    'bal': balance,
+                    'prorata': prorata_amt}
+                tmp['total_vat'] += prorata_amt
+            else:
+                tmp[kind][columns['line_id'][i]] = {
+                    'bal': balance,
+                    'vat_rate': columns['vat_rate'][i],
+                    'weight': columns['weight'][i],
+                    }
+                tmp['total_weight_' + kind] = columns['total_weight'][i]
+        return tmp
+
+    def _get_columns_move_layout(self, columns, start, end, speedy):
+        """Return a tuple (vat_idx, acc_type, acc_idx) for the slice of
+        a move: indexes of the VAT lines, type and indexes of the expense
+        lines on which the VAT pro rata is allocated.
+        It doesn't depend on the ratio."""
+        ccur = speedy['currency']
+        kinds = columns['kind']
+        total_weights = columns['total_weight']
+        idx_by_kind = ([], [], [])
+        for i in range(start, end):
+            idx_by_kind[kinds[i]].append(i)
+        vat_idx, tax_idx, notax_idx = idx_by_kind
+        if vat_idx and not tax_idx and not notax_idx:
+            self._check_work_move(self._columns_to_work_move(
+                columns, start, end, speedy))
+        if tax_idx and not ccur.is_zero(total_weights[tax_idx[0]]):
+            return vat_idx, 'other_tax', tax_idx
+        if notax_idx and not ccur.is_zero(total_weights[notax_idx[0]]):
+            return vat_idx, 'other_notax', notax_idx
+        self._raise_unsupported_move(columns['move_id'][start])
+
+    @api.model
+    def _get_columns_move_amounts(self, columns, vat_idx, acc_idx, ccur, ratio):
+        """Return a tuple (proratas, total_vat, counterparts) with
+        the amounts of the VAT lines and of the expense lines of a move.
+        The float operations are the same and done in the same order as
+        in _prepare_prorata_lines(), so the amounts are the same cent for
+        cent, including the remainder allocated to the last line."""
+        balances = columns['balance']
+        weights = columns['weight']
+        proratas = [ccur.round(ratio * balances[i]) for i in vat_idx]
+        total_vat = 0.0
+        for prorata_amt in proratas:
+            total_vat += prorata_amt
+        count = len(acc_idx)
+        vat_left = total_vat  # already rounded
+        total_weight = columns['total_weight'][acc_idx[0]]
+        counterparts = []
+        for i in acc_idx:
+            if count == 1:
+                amt = ccur.round(vat_left)  # rounding "optional" here
+            else:
+                amt = ccur.round(total_vat * weights[i] / total_weight)
+            vat_left -= amt
+            counterparts.append(amt)
+            count -= 1
+        return proratas, total_vat, counterparts
+
+    @api.model
+    def _get_columns_move_amounts_multi(
+            self, columns, vat_idx, acc_idx, ccur, ratios):
+        """Same as _get_columns_move_amounts() for several ratios, in a
+        single pass over the journal items of the move.
+        Return a tuple (proratas, counterparts): one list of amounts per
+        VAT line and per expense line, with one amount per ratio."""
+        balances = columns['balance']
+        weights = columns['weight']
+        total_weight = columns['total_weight'][acc_idx[0]]
+        total_vats = [0.0] * len(ratios)
+        proratas = []
+        for i in vat_idx:
+            amts = [ccur.round(ratio * balances[i]) for ratio in ratios]
+            for index, amt in enumerate(amts):
+                total_vats[index] += amt
+            proratas.append(amts)
+        vat_lefts = list(total_vats)  # already rounded
+        last = acc_idx[-1]
+        counterparts = []
+        for i in acc_idx:
+            if i == last:
+                amts = [ccur.round(vat_left) for vat_left in vat_lefts]
+            else:
+                amts = [
+                    ccur.round(total_vat * weights[i] / total_weight)
+                    for total_vat in total_vats]
+            for index, amt in enumerate(amts):
+                vat_lefts[index] -= amt
+            counterparts.append(amts)
+        return proratas, counterparts
+
+    def _prepare_prorata_lines_from_columns(self, columns, speedy, trace=None):
+        """Same as _prepare_prorata_lines() but works directly on the flat
+        arrays of the SQL engine, slice by slice, without building the
+        nested dicts of each move."""
+        ccur = speedy['currency']
+        ratio = speedy['ratio']
+        line_ids = columns['line_id']
+        balances = columns['balance']
+        vat_rates = columns['vat_rate']
+        kinds = columns['kind']
+        vals_list = []
+        for start, end in self._iter_column_groups(columns):
+            vat_idx, acc_type, acc_idx = self._get_columns_move_layout(
+                columns, start, end, speedy)
+            proratas, total_vat, counterparts = \
+                self._get_columns_move_amounts(
+                    columns, vat_idx, acc_idx, ccur, ratio)
+            if trace is not None:
+                move_kinds = kinds[start:end]
+                trace.append((
+                    columns['move_id'][start], acc_type, len(vat_idx),
+                    move_kinds.count(1), move_kinds.count(2), total_vat))
+            for i, amt in zip(acc_idx, counterparts):
+                vals_list.append({
+                    'parent_id': self.id,
+                    'line_id': line_ids[i],
+                    'counterpart_amount': amt,
+                    'vat_rate': vat_rates[i],
+                    'original_amount': balances[i],
+                    })
+            for i, prorata_amt in zip(vat_idx, proratas):
+                vals_list.append({
+                    'parent_id': self.id,
+                    'line_id': line_ids[i],
+                    'original_vat_amount': balances[i],
+                    'prorata_vat_amount': prorata_amt,
+                    })
+        return vals_list
+
+    def simulate_ratios(self, ratios):
+        """What-if simulation: return the amounts of the VAT pro rata
+        entry for each ratio of the list (in %, like used_perct), without
+        creating VAT pro rata lines nor journal entries.
+        The journal items are classified once by a read-only query (the
+        classification stored on the journal items is not updated) ; the
+        amounts of all the ratios are computed in a single pass over the
+        journal items.
+        Return a list of dicts (one per ratio) with keys 'ratio',
+        'lines' (list of dicts with keys account_id, account_code,
+        start_date, end_date, debit, credit ordered by account code and
+        dates, grouped like the lines of the VAT pro rata entry),
+        'total_debit' and 'total_credit'."""
+        self.ensure_one()
+        speedy = self._prepare_speed_dict()
+        ccur = speedy['currency']
+        factors = [(100.0 - ratio) / 100.0 for ratio in ratios]
+        # key = (account_id, start_date, end_date),
+        # value = list of amounts (one per ratio)
+        # amount > 0 = credit, like in _get_move_line_amounts()
+        key2amounts = defaultdict(lambda: [0.0] * len(ratios))
+        acc2code = {}
+        for moves in self._iter_prorata_move_chunks(
+                self._get_prorata_move_domain()):
+            # the simulation doesn't write the classification
+            columns = self._prorata_columns_sql(
+                moves.ids, speedy, store_kind=False)
+            if not columns['line_id']:
+                continue
+            line2key = {}
+            self._cr.execute("""
+                SELECT aml.id, aml.account_id, aa.code,
+                    aml.start_date, aml.end_date
+                FROM account_move_line aml
+                JOIN account_account aa ON aa.id = aml.account_id
+                WHERE aml.id IN %s
+                """, (tuple(columns['line_id']), ))
+            for line_id, account_id, account_code, start_date, end_date in \
+                    self._cr.fetchall():
+                line2key[line_id] = (account_id, start_date, end_date)
+                acc2code[account_id] = account_code
+            line_ids = columns['line_id']
+            for start, end in self._iter_column_groups(columns):
+                vat_idx, acc_type, acc_idx = self._get_columns_move_layout(
+                    columns, start, end, speedy)
+                vat_keys = [line2key[line_ids[i]] for i in vat_idx]
+                other_keys = [line2key[line_ids[i]] for i in acc_idx]
+                proratas, counterparts = \
+                    self._get_columns_move_amounts_multi(
+                        columns, vat_idx, acc_idx, ccur, factors)
+                for key, amts in zip(vat_keys, proratas):
+                    key_amounts = key2amounts[key]
+                    for index, amt in enumerate(amts):
+                        key_amounts[index] += amt
+                for key, amts in zip(other_keys, counterparts):
+                    key_amounts = key2amounts[key]
+                    for index, amt in enumerate(amts):
+                        key_amounts[index] -= amt
+        # same order as _get_move_line_amounts(): empty dates last
+        keys = sorted(key2amounts, key=lambda x: (
+            acc2code[x[0]], x[1] is None, x[1], x[2] is None, x[2]))
+        res = []
+        for index, ratio in enumerate(ratios):
+            lines = []
+            total_debit = total_credit = 0.0
+            for key in keys:
+                account_id, start_date, end_date = key
+                amount = ccur.round(key2amounts[key][index])
+                if ccur.is_zero(amount):
+                    continue
+                debit = credit = 0.0
+                if amount > 0:
+                    credit = amount
+                else:
+                    debit = -amount
+                lines.append({
+                    'account_id': account_id,
+                    'account_code': acc2code[account_id],
+                    'start_date': start_date or False,
+                    'end_date': end_date or False,
+                    'debit': debit,
+                    'credit': credit,
+                    })
+                total_debit += debit
+                total_credit += credit
+            res.append({
+                'ratio': ratio,
+                'lines': lines,
+                'total_debit': ccur.round(total_debit),
+                'total_credit': ccur.round(total_credit),
+                })
+        return res
+
+    @api.model
+    def _get_move_chunk_size(self):
+        # 0 = process all the moves of the period at once (one IN query
+        # with all the move IDs): only for small periods
+        if 'vat_prorata_move_chunk_size' in self._context:
+            return self._context['vat_prorata_move_chunk_size']
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_vat_pro_rata.move_chunk_size', MOVE_CHUNK_SIZE))
+
+    def _iter_prorata_move_chunks(self, domain):
+        """Yield the source moves by chunks ordered by ID. When the
+        streaming mode is enabled, the pending updates are flushed and the
+        cache is cleared between chunks, so that the memory used doesn't
+        depend on the size of the period."""
+        amo = self.env['account.move']
+        chunk_size = self._get_move_chunk_size()
+        if not chunk_size:
+            yield amo.search(domain)
+            return
+        last_id = 0
+        while True:
+            moves = amo.search(
+                domain + [('id', '>', last_id)], order='id', limit=chunk_size)
+            if not moves:
+                break
+            last_id = moves.ids[-1]
+            yield moves
+            if len(moves) < chunk_size:
+                break
+            self.flush()
+            self.invalidate_cache()
+
+    @api.model
+    def _get_prorata_watermark(self):
+        """Return the start of the oldest transaction in progress on the
+        database. The write_date of the journal entries written by
+        a concurrent transaction, not visible by the generation, is the
+        start of that transaction: it is after the watermark, so these
+        journal entries are processed by the next incremental generation.
+        A margin of one second covers the clock precision."""
+        self._cr.execute("""
+            SELECT MIN(xact_start) AT TIME ZONE 'UTC'
+            FROM pg_stat_activity
+            WHERE datname = current_database()
+            AND xact_start IS NOT NULL
+            """)
+        oldest = self._cr.fetchone()[0]
+        now = self._cr.now()
+        if not oldest or oldest > now:
+            oldest = now
+        return oldest - relativedelta(seconds=1)
+
+    def _get_prorata_signature(self, speedy):
+        """The lines can be regenerated incrementally only if all the
+        parameters used to compute them are unchanged"""
+        self.ensure_one()
+        key = (
+            self.company_id.id,
+            str(self.date_from),
+            str(self.date_to),
+            self.target_move,
+            sorted(self.source_journal_ids.ids),
+            self.used_perct,
+            sorted(speedy['vat_deduc_account_ids']),
+            sorted(speedy['vattax2rate'].items()),
+            sorted(speedy['acc2type'].items()),
+            )
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _prepare_incremental_prorata_lines(self, domain):
+        """Delete the lines of the moves that were modified, removed or that
+        don't match the domain any more since the last generation. Return the
+        domain of the moves to process"""
+        self.ensure_one()
+        avplo = self.env['account.vat.prorata.line']
+        amo = self.env['account.move']
+        watermark = self.prorata_watermark
+        changed_domain = domain + [
+            '|',
+            ('write_date', '>', watermark),
+            ('line_ids.write_date', '>', watermark)]
+        stale_lines = avplo.search([
+            ('parent_id', '=', self.id),
+            '|', '|',
+            ('line_id', '=', False),
+            ('move_id', 'in', amo._search(changed_domain)),
+            ('move_id', 'not in', amo._search(domain)),
+            ])
+        logger.info(
+            'VAT prorata ID %d: incremental generation, %d lines to delete',
+            self.id, len(stale_lines))
+        self._sql_delete_children(
+            'account.vat.prorata.line', ids=stale_lines.ids)
+        return changed_domain
+
+    def _prorata_columns_consolidation(self, periods):
+        """Return the columns of the SQL engine (cf _prorata_columns_sql())
+        rebuilt from the VAT pro rata lines of the periods, which hold the
+        journal items already classified. Only the expense lines on which
+        the VAT was allocated are kept in the VAT pro rata lines, so they
+        all get the kind 'other_tax' ; the allocation only depends on
+        their weight."""
+        columns = {
+            'line_id': array('q'),
+            'move_id': array('q'),
+            'balance': array('d'),
+            'kind': array('b'),
+            'vat_rate': array('d'),
+            'weight': array('d'),
+            'total_weight': array('d'),
+            }
+        self.env['account.vat.prorata.line'].flush()
+        query = """
+            SELECT
+                line_id, move_id, original_vat_amount, original_amount,
+                vat_rate
+            FROM account_vat_prorata_line
+            WHERE parent_id IN %s
+            AND line_id IS NOT NULL
+            ORDER BY move_id, line_id
+            """
+        tax_code = PRORATA_KINDS.index('other_tax')
+        for (
+                line_id, move_id, original_vat_amount, original_amount,
+                vat_rate) in self._iter_cursor_rows(
+                    query, (tuple(periods.ids), ),
+                    'vat_prorata_consolidation'):
+            columns['line_id'].append(line_id)
+            columns['move_id'].append(move_id)
+            columns['total_weight'].append(0.0)
+            if original_vat_amount:
+                columns['balance'].append(original_vat_amount)
+                columns['kind'].append(0)
+                columns['vat_rate'].append(0.0)
+                columns['weight'].append(0.0)
+            else:
+                columns['balance'].append(original_amount)
+                columns['kind'].append(tax_code)
+                columns['vat_rate'].append(vat_rate)
+                columns['weight'].append(vat_rate * original_amount)
+        self._set_columns_total_weight(columns)
+        return columns
+
+    def _generate_consolidated_prorata_lines(self, speedy):
+        """Generate the VAT pro rata lines from the VAT pro rata lines of
+        the periods, reweighted with the ratio of the consolidation"""
+        self.ensure_one()
+        periods = self._check_consolidated_proratas()
+        self._sql_delete_children('account.vat.prorata.line')
+        stats = {}
+        with self._track_phase(stats, 'classification') as tracker:
+            columns = self._prorata_columns_consolidation(periods)
+            tracker['rows'] = len(columns['line_id'])
+        with self._track_phase(stats, 'line_creation') as tracker:
+            vals_list = self._prepare_prorata_lines_from_columns(
+                columns, speedy)
+            self.env['account.vat.prorata.line']._bulk_create(vals_list)
+            tracker['rows'] = len(vals_list)
+        # the next generation without consolidation must be a full one
+        self.write({
+            'prorata_watermark': False,
+            'prorata_signature': False,
+            })
+        self._refresh_line_summary()
+        self._save_phase_stats(stats)
+
+    def generate_prorata_lines(self):
+        avplo = self.env['account.vat.prorata.line']
+        # Prepare datas
+        speedy = self._prepare_speed_dict()
+        if self.consolidation:
+            return self._generate_consolidated_prorata_lines(speedy)
+        engine = self._get_prorata_engine()
+        domain = self._get_prorata_move_domain()
+        signature = self._get_prorata_signature(speedy)
+        watermark = self._get_prorata_watermark()
+        if (
+                self.prorata_watermark and
+                self.prorata_signature == signature and
+                not self._context.get('vat_prorata_full_recompute')):
+            domain = self._prepare_incremental_prorata_lines(domain)
+        else:
+            # delete existing prorata lines
+            self._sql_delete_children('account.vat.prorata.line')
+        # trace is None when disabled, so that the default path
+        # doesn't do any formatting work
+        trace = [] if self._is_prorata_trace_enabled() else None
+        stats = {}
+        job_obj = self.env['account.vat.prorata.job']
+        progress_total = 0
+        progress_done = 0
+        if self._context.get('vat_prorata_job_id'):
+            progress_total = self.env['account.move'].search_count(domain)
+            job_obj._report_progress(0, progress_total)
+        chunks = self._iter_prorata_move_chunks(domain)
+        while True:
+            with self._track_phase(stats, 'move_search') as tracker:
+                moves = next(chunks, None)
+                tracker['rows'] = len(moves or [])
+            if moves is None:
+                break
+            with self._track_phase(stats, 'classification') as tracker:
+                if engine == 'python':
+                    work_moves = self._prorata_work_moves_python(
+                        moves, speedy)
+                    tracker['rows'] = len(work_moves)
+                else:
+                    columns = self._prorata_columns_sql(moves.ids, speedy)
+                    tracker['rows'] = len(columns['line_id'])
+            # Create lines
+            with self._track_phase(stats, 'line_creation') as tracker:
+                if engine == 'python':
+                    vals_list = self._prepare_prorata_lines(
+                        work_moves, speedy['currency'], trace=trace)
+                else:
+                    vals_list = self._prepare_prorata_lines_from_columns(
+                        columns, speedy, trace=trace)
+                avplo._bulk_create(vals_list)
+                tracker['rows'] = len(vals_list)
+            if progress_total:
+                progress_done += len(moves)
+                job_obj._report_progress(progress_done, progress_total)
+        if trace is not None:
+            self._write_prorata_trace(trace, engine)
+        self.write({
+            'prorata_watermark': watermark,
+            'prorata_signature': signature,
+            })
+        self._refresh_line_summary()
+        self._save_phase_stats(stats)
+
+    def _refresh_line_summary(self):
+        """Store the summary by account of the VAT pro rata lines and
+        their number, computed with read_group"""
+        if not self:
+            return
+        avplso = self.env['account.vat.prorata.line.summary']
+        self._sql_delete_children('account.vat.prorata.line.summary')
+        self.env['account.vat.prorata.line'].flush()
+        vals_list = []
+        for rec in self:
+            line_count = 0
+            groups = self.env['account.vat.prorata.line'].read_group(
+                [('parent_id', '=', rec.id)],
+                ['account_id', 'original_amount', 'counterpart_amount',
+                 'original_vat_amount', 'prorata_vat_amount'],
+                ['account_id'], orderby='account_id', lazy=False)
+            for group in groups:
+                line_count += group['__count']
+                vals_list.append({
+                    'parent_id': rec.id,
+                    'account_id': group['account_id'] and
+                    group['account_id'][0] or False,
+                    'line_count': group['__count'],
+                    'original_amount': group['original_amount'],
+                    'counterpart_amount': group['counterpart_amount'],
+                    'original_vat_amount': group['original_vat_amount'],
+                    'prorata_vat_amount': group['prorata_vat_amount'],
+                    })
+            rec.write({'line_count': line_count})
+        avplso.create(vals_list)
+
+    def _is_prorata_trace_enabled(self):
+        self.ensure_one()
+        if 'vat_prorata_trace' in self._context:
+            return bool(self._context['vat_prorata_trace'])
+        return self.company_id.vat_prorata_trace
+
+    def _write_prorata_trace(self, trace, engine):
+        """Attach the classification decisions to the VAT pro rata record.
+        trace is a list of tuples (move_id, acc_type, vat line count,
+        other_tax line count, other_notax line count, total VAT)"""
+        self.ensure_one()
+        move_id2name = {}
+        move_ids = [entry[0] for entry in trace]
+        amo = self.env['account.move']
+        for i in range(0, len(move_ids), 1000):
+            for move in amo.browse(move_ids[i:i + 1000]).read(['name']):
+                move_id2name[move['id']] = move['name']
+        rows = [
+            'move_id;move;decision;vat_lines;other_tax_lines;'
+            'other_notax_lines;total_vat']
+        for (move_id, acc_type, vat_cnt, tax_cnt, notax_cnt, total_vat) in \
+                trace:
+            rows.append('%d;%s;%s;%d;%d;%d;%s' % (
+                move_id, move_id2name.get(move_id, ''), acc_type, vat_cnt,
+                tax_cnt, notax_cnt, total_vat))
+        filename = 'vat_prorata_trace_%s_%s.csv' % (
+            self.date_from, self.date_to)
+        self.env['ir.attachment'].create({
+            'name': filename,
+            'res_model': self._name,
+            'res_id': self.id,
+            'datas': base64.b64encode('\n'.join(rows).encode('utf-8')),
+            'mimetype': 'text/csv',
+            })
+        self.message_post(body=_(
+            "Trace of the classification of %d journal entries "
+            "(engine: %s) attached in <em>%s</em>.") % (
+                len(trace), engine, filename))
+        logger.info(
+            'VAT prorata ID %d: trace of %d moves attached in %s',
+            self.id, len(trace), filename)
+
+    def _iter_cursor_rows(self, query, params, cursor_name, chunk_size=5000):
+        """Yield the rows of the query read from a server-side cursor by
+        chunks, so that the memory used doesn't depend on the number of
+        rows"""
+        cr = self._cr
+        cr.execute(
+            'DECLARE ' + cursor_name + ' NO SCROLL CURSOR FOR ' + query,
+            params)
+        try:
+            while True:
+                cr.execute(
+                    'FETCH FORWARD %s FROM ' + cursor_name, (chunk_size, ))
+                rows = cr.fetchall()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cr.execute('CLOSE ' + cursor_name)
+
+    def _get_audit_export_queries(self):
+        """Return a dict with key = section and value = tuple
+        (header, query, params). 'lines' is the detail of the VAT pro rata
+        lines, 'moves' is the reconciliation of each source journal entry:
+        pro rata VAT vs allocated counterpart."""
+        self.ensure_one()
+        lines_query = """
+            SELECT
+                am.name,
+                avpl.date,
+                aa.code,
+                rp.name,
+                avpl.ref,
+                avpl.label,
+                avpl.vat_rate,
+                COALESCE(avpl.original_amount, 0),
+                COALESCE(avpl.counterpart_amount, 0),
+                COALESCE(avpl.original_vat_amount, 0),
+                COALESCE(avpl.prorata_vat_amount, 0)
+            FROM account_vat_prorata_line avpl
+            LEFT JOIN account_move am ON am.id = avpl.move_id
+            LEFT JOIN account_account aa ON aa.id = avpl.account_id
+            LEFT JOIN res_partner rp ON rp.id = avpl.partner_id
+            WHERE avpl.parent_id = %s
+            ORDER BY avpl.move_id, avpl.id
+            """
+        moves_query = """
+            SELECT
+                am.name,
+                am.date,
+                SUM(COALESCE(avpl.prorata_vat_amount, 0)),
+                SUM(COALESCE(avpl.counterpart_amount, 0)),
+                SUM(COALESCE(avpl.prorata_vat_amount, 0)) -
+                    SUM(COALESCE(avpl.counterpart_amount, 0))
+            FROM account_vat_prorata_line avpl
+            LEFT JOIN account_move am ON am.id = avpl.move_id
+            WHERE avpl.parent_id = %s
+            GROUP BY avpl.move_id, am.name, am.date
+            ORDER BY avpl.move_id
+            """
+        return {
+            'lines': (
+                [
+                    _('Journal Entry'), _('Date'), _('Account'),
+                    _('Partner'), _('Reference'), _('Label'), _('VAT Rate'),
+                    _('Expense Amount'), _('Counter-part Amount'),
+                    _('VAT Amount'), _('Pro Rata VAT Amount')],
+                lines_query, (self.id, )),
+            'moves': (
+                [
+                    _('Journal Entry'), _('Date'), _('Pro Rata VAT Amount'),
+                    _('Allocated Counter-part Amount'), _('Difference')],
+                moves_query, (self.id, )),
+            }
+
+    def _attach_audit_file(self, filename, tmp):
+        """Attach the temporary file tmp. With the file storage, the file
+        is hashed and copied to the filestore by blocks, so that it is
+        never loaded in memory. The mimetype application/octet-stream
+        avoids the full text indexation of the file."""
+        iao = self.env['ir.attachment']
+        vals = {
+            'name': filename,
+            'res_model': self._name,
+            'res_id': self.id,
+            'mimetype': 'application/octet-stream',
+            }
+        tmp.seek(0)
+        if iao._storage() == 'db':
+            # the database storage needs the content in memory
+            vals['raw'] = tmp.read()
+            return iao.create(vals)
+        sha = hashlib.sha1()
+        file_size = 0
+        for block in iter(lambda: tmp.read(AUDIT_BLOCK_SIZE), b''):
+            sha.update(block)
+            file_size += len(block)
+        checksum = sha.hexdigest()
+        # same path as ir.attachment _get_path()
+        fname = checksum[:2] + '/' + checksum
+        full_path = iao._full_path(fname)
+        if not os.path.isfile(full_path):
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            tmp.seek(0)
+            with open(full_path, 'wb') as dest:
+                shutil.copyfileobj(tmp, dest, AUDIT_BLOCK_SIZE)
+        # the file is removed by the garbage collector of the filestore
+        # if the transaction is rolled back
+        iao._mark_for_gc(fname)
+        attachment = iao.create(vals)
+        self._cr.execute("""
+            UPDATE ir_attachment
+            SET store_fname=%s, file_size=%s, checksum=%s, db_datas=NULL
+            WHERE id=%s
+            """, (fname, file_size, checksum, attachment.id))
+        attachment.invalidate_cache(
+            ['store_fname', 'file_size', 'checksum', 'db_datas'],
+            attachment.ids)
+        return attachment
+
+    def _write_audit_csv(self, section, header, rows):
+        with tempfile.TemporaryFile() as tmp:
+            text = io.TextIOWrapper(tmp, encoding='utf-8', newline='')
+            writer = csv.writer(text, delimiter=';')
+            writer.writerow(header)
+            count = 0
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+            text.flush()
+            text.detach()
+            filename = 'vat_prorata_audit_%s_%s_%s.csv' % (
+                section, self.date_from, self.date_to)
+            self._attach_audit_file(filename, tmp)
+        return filename, count
+
+    def _write_audit_xlsx(self, sections):
+        """sections: list of tuples (section, header, rows)"""
+        with tempfile.TemporaryFile() as tmp:
+            # constant_memory: each row is written to disk as soon as
+            # the next one starts
+            workbook = xlsxwriter.Workbook(tmp, {
+                'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+            count = 0
+            for section, header, rows in sections:
+                sheet = workbook.add_worksheet(section)
+                sheet.write_row(0, 0, header)
+                row_index = 0
+                for row_index, row in enumerate(rows, 1):
+                    sheet.write_row(row_index, 0, row)
+                if section == 'lines':
+                    count = row_index
+            workbook.close()
+            filename = 'vat_prorata_audit_%s_%s.xlsx' % (
+                self.date_from, self.date_to)
+            self._attach_audit_file(filename, tmp)
+        return [filename], count
+
+    def export_audit_file(self, file_format='csv'):
+        """Attach the detail of the VAT pro rata lines and the
+        reconciliation by source journal entry, for the tax auditors.
+        The rows are streamed from a server-side cursor."""
+        self.ensure_one()
+        if file_format == 'xlsx' and xlsxwriter is None:
+            raise UserError(_(
+                "The Python library xlsxwriter is not installed."))
+        self.env['account.vat.prorata.line'].flush()
+        sections = [
+            (section, header, self._iter_cursor_rows(
+                query, params, 'vat_prorata_audit_%s' % section))
+            for (section, (header, query, params)) in
+            self._get_audit_export_queries().items()]
+        if file_format == 'xlsx':
+            filenames, count = self._write_audit_xlsx(sections)
+        else:
+            filenames = []
+            for section, header, rows in sections:
+                filename, section_count = self._write_audit_csv(
+                    section, header, rows)
+                filenames.append(filename)
+                if section == 'lines':
+                    count = section_count
+        self.message_post(body=_(
+            "Audit export of %d VAT pro rata lines attached in "
+            "<em>%s</em>.") % (count, ', '.join(filenames)))
+        logger.info(
+            'VAT prorata ID %d: audit export of %d lines attached in %s',
+            self.id, count, filenames)
+        return True
+
+    def button_export_audit_csv(self):
+        return self.export_audit_file('csv')
+
+    def button_export_audit_xlsx(self):
+        return self.export_audit_file('xlsx')
+
+    def _prepare_prorata_lines(self, work_moves, ccur, trace=None):
+        vals_list = []
         for work_move in work_moves:
             if (
                     work_move['other_tax'] and
                     not ccur.is_zero(work_move['total_weight_other_tax'])):
-                self.expense_prorata_line_create(work_move, 'other_tax', ccur)
+                acc_type = 'other_tax'
             elif (
                     work_move['other_notax'] and
                     not ccur.is_zero(work_move['total_weight_other_notax'])):
-                self.expense_prorata_line_create(
-                    work_move, 'other_notax', ccur)
+                acc_type = 'other_notax'
             else:
-                raise UserError(_(
-                    'This scenario is not supported (debug: %s)') % work_move)
+                self._raise_unsupported_move(work_move['move_id'])
+            if trace is not None:
+                trace.append((
+                    work_move['move_id'], acc_type, len(work_move['vat']),
+                    len(work_move['other_tax']),
+                    len(work_move['other_notax']), work_move['total_vat']))
+            vals_list += self._prepare_expense_prorata_lines(
+                work_move, acc_type, ccur)
             for line_id, ldict in work_move['vat'].items():
-                avplo.create({
+                vals_list.append({
                     'parent_id': self.id,
                     'line_id': line_id,
                     'original_vat_amount': ldict['bal'],
                     'prorata_vat_amount': ldict['prorata'],
                     })
-        return
+        return vals_list
 
-    def expense_prorata_line_create(self, work_move, acc_type, ccur):
-        avplo = self.env['account.vat.prorata.line']
+    def _prepare_expense_prorata_lines(self, work_move, acc_type, ccur):
+        vals_list = []
         i = len(work_move[acc_type])
         vat_left = work_move['total_vat']  # already rounded
         for line_id, ldict in work_move[acc_type].items():
@@ -382,7 +1667,7 @@ class AccountVatProrata(models.Model):
                     work_move['total_vat'] * ldict['weight'] /
                     work_move['total_weight_' + acc_type])
             vat_left -= amt
-            avplo.create({
+            vals_list.append({
                 'parent_id': self.id,
                 'line_id': line_id,
                 'counterpart_amount': amt,
@@ -390,27 +1675,57 @@ class AccountVatProrata(models.Model):
                 'original_amount': ldict['bal'],
                 })
             i -= 1
+        return vals_list
 
-    def prepare_move(self):
+    def expense_prorata_line_create(self, work_move, acc_type, ccur):
+        return self.env['account.vat.prorata.line']._bulk_create(
+            self._prepare_expense_prorata_lines(work_move, acc_type, ccur))
+
+    def _get_move_line_amounts(self, bucket=None):
+        """Return the amounts of the VAT pro rata entry, grouped by account,
+        start date and end date, with a single query on the VAT pro rata
+        lines. bucket can be 'month' (month of the source journal item) or
+        'move' (source journal entry) to group them further.
+        Return a list of tuples
+        (bucket, account_id, account_code, start_date, end_date, amount)
+        ordered by bucket and account code"""
         self.ensure_one()
-        company = self.company_id
-        ccur = company.currency_id
-        if not self.line_ids:
-            raise UserError(_('There are no lines'))
-        dlines = defaultdict(float)
-        for line in self.line_ids:
-            if not ccur.is_zero(line.prorata_vat_amount):
-                amt = line.prorata_vat_amount
-            elif not ccur.is_zero(line.counterpart_amount):
-                amt = - line.counterpart_amount
-            else:
-                continue
+        bucket_sql = {
+            'month': "date_trunc('month', avpl.date)::date",
+            'move': 'avpl.move_id',
+            }.get(bucket, 'NULL')
+        self.env['account.vat.prorata.line'].flush()
+        # prorata_vat_amount and counterpart_amount are rounded
+        # to the currency, so '!= 0' is the same as 'not is_zero()'
+        self._cr.execute("""
+            SELECT
+                """ + bucket_sql + """ AS bucket,
+                avpl.account_id,
+                aa.code,
+                avpl.start_date,
+                avpl.end_date,
+                SUM(CASE
+                    WHEN avpl.prorata_vat_amount != 0
+                        THEN avpl.prorata_vat_amount
+                    ELSE -avpl.counterpart_amount
+                    END)
+            FROM account_vat_prorata_line avpl
+            JOIN account_account aa ON aa.id = avpl.account_id
+            WHERE avpl.parent_id = %s
+            AND (
+                avpl.prorata_vat_amount != 0 OR
+                avpl.counterpart_amount != 0)
+            GROUP BY 1, avpl.account_id, aa.code, avpl.start_date,
+                avpl.end_date
+            ORDER BY 1, aa.code, avpl.start_date, avpl.end_date
+            """, (self.id, ))
+        return self._cr.fetchall()
 
-            key = (
-                line.account_id,
-                line.start_date or False,
-                line.end_date or False)
-            dlines[key] += amt
+    def _prepare_move_vals(self, date, ref, amount_rows):
+        """amount_rows: list of tuples
+        (account_id, account_code, start_date, end_date, amount)
+        ordered by account code"""
+        ccur = self.company_id.currency_id
         lines = []
         # Needed to neutralise default asset profile that may be
         # configured on asset account and that will block
@@ -418,14 +1733,12 @@ class AccountVatProrata(models.Model):
         asset_installed = False
         if hasattr(self.env['account.account'], 'asset_profile_id'):
             asset_installed = True
-        # for ordering by account code
-        for (key, amount) in dlines.items():
-            account, start_date, end_date = key
+        for (account_id, account_code, start_date, end_date, amount) in \
+                amount_rows:
             lvals = {
-                'start_date': start_date,
-                'end_date': end_date,
-                'account_id': account.id,
-                'account_code': account.code,  # for sorting
+                'start_date': start_date or False,
+                'end_date': end_date or False,
+                'account_id': account_id,
                 }
             if asset_installed:
                 lvals['asset_profile_id'] = False
@@ -436,25 +1749,227 @@ class AccountVatProrata(models.Model):
                 lvals['debit'] = amount * -1
             lines.append(lvals)
 
-        # Order by account code
-        ordered_lines = sorted(lines, key=lambda x: x['account_code'])
         vals = {
-            'date': self.date_to,
+            'date': date,
             'journal_id': self.journal_id.id,
-            'ref': self.move_label,
-            'line_ids': [x.pop('account_code') and (0, 0, x) for x in ordered_lines],
-            'company_id': company.id,
+            'ref': ref,
+            'line_ids': [(0, 0, x) for x in lines],
+            'company_id': self.company_id.id,
+            'vat_prorata_id': self.id,
             }
         return vals
 
-    def button_generate_move(self):
+    def _check_has_lines(self):
         self.ensure_one()
-        self.generate_prorata_lines()
-        move = self.env['account.move'].create(self.prepare_move())
-        self.write({
-            'state': 'done',
-            'move_id': move.id,
-            })
+        if not self.env['account.vat.prorata.line'].search_count(
+                [('parent_id', '=', self.id)]):
+            raise UserError(_('There are no lines'))
+
+    def prepare_move(self):
+        self.ensure_one()
+        self._check_has_lines()
+        amount_rows = [row[1:] for row in self._get_move_line_amounts()]
+        return self._prepare_move_vals(
+            self.date_to, self.move_label, amount_rows)
+
+    def _prepare_moves_by_month(self):
+        moves_vals = []
+        month2rows = defaultdict(list)
+        for row in self._get_move_line_amounts(bucket='month'):
+            month2rows[row[0]].append(row[1:])
+        for month, amount_rows in sorted(month2rows.items()):
+            date = min(month + relativedelta(day=31), self.date_to)
+            ref = '%s (%s)' % (self.move_label, month.strftime('%m/%Y'))
+            moves_vals.append(
+                self._prepare_move_vals(date, ref, amount_rows))
+        return moves_vals
+
+    def _prepare_moves_by_lines(self):
+        """Group the source journal entries so that each VAT pro rata entry
+        has at most move_split_max_lines lines. As the lines of each source
+        journal entry are balanced, each VAT pro rata entry is balanced."""
+        max_lines = max(self.move_split_max_lines, 1)
+        move2rows = defaultdict(list)
+        for row in self._get_move_line_amounts(bucket='move'):
+            move2rows[row[0]].append(row[1:])
+        chunks = []
+        chunk = {}
+        for source_move_id in sorted(move2rows):
+            rows = move2rows[source_move_id]
+            new_keys = {row[:4] for row in rows if row[:4] not in chunk}
+            if chunk and len(chunk) + len(new_keys) > max_lines:
+                chunks.append(chunk)
+                chunk = {}
+            for row in rows:
+                chunk[row[:4]] = chunk.get(row[:4], 0.0) + row[4]
+        if chunk:
+            chunks.append(chunk)
+        moves_vals = []
+        for index, chunk in enumerate(chunks, 1):
+            amount_rows = [
+                key + (amount, ) for (key, amount) in sorted(
+                    chunk.items(),
+                    key=lambda x: (
+                        x[0][1], str(x[0][2] or ''), str(x[0][3] or '')))]
+            ref = '%s (%d/%d)' % (self.move_label, index, len(chunks))
+            moves_vals.append(
+                self._prepare_move_vals(self.date_to, ref, amount_rows))
+        return moves_vals
+
+    def _prepare_moves(self):
+        """Return the list of values of the VAT pro rata entries"""
+        self.ensure_one()
+        if self.move_split == 'month':
+            self._check_has_lines()
+            return self._prepare_moves_by_month()
+        elif self.move_split == 'lines':
+            self._check_has_lines()
+            return self._prepare_moves_by_lines()
+        return [self.prepare_move()]
+
+    @api.model
+    def _create_prorata_moves(self, moves_vals):
+        """Create the VAT pro rata entries: the journal entries are created
+        without lines, then all the lines are created in batches and the
+        balance of the entries is checked once at the end. The VAT pro
+        rata entries are balanced general entries without taxes, so the
+        synchronization done line by line by account.move.create() is not
+        needed."""
+        amo = self.env['account.move']
+        amlo = self.env['account.move.line'].with_context(
+            check_move_validity=False)
+        moves = amo.create([
+            {key: value for (key, value) in move_vals.items()
+             if key != 'line_ids'}
+            for move_vals in moves_vals])
+        lines_vals = []
+        for move, move_vals in zip(moves, moves_vals):
+            for line_cmd in move_vals['line_ids']:
+                lines_vals.append(dict(line_cmd[2], move_id=move.id))
+        chunk_size = self.env[
+            'account.vat.prorata.line']._get_create_chunk_size()
+        for i in range(0, len(lines_vals), chunk_size):
+            amlo.create(lines_vals[i:i + chunk_size])
+        moves._check_balanced()
+        return moves
+
+    def _get_anomaly_query(self, move_ids):
+        """Query returning the source journal entries that would block the
+        generation of the VAT pro rata lines, with the same rules as
+        _check_work_move() and _prepare_prorata_lines(), read from the
+        classification stored on the journal items.
+        Return rows (move_id, reason, vat_amount, expense_line_count)"""
+        request = """
+            SELECT
+                move_id,
+                CASE
+                    WHEN COUNT(*) FILTER (WHERE kind != 'vat') = 0
+                        THEN 'vat_without_expense'
+                    ELSE 'zero_expense_weight'
+                END AS reason,
+                SUM(balance) FILTER (WHERE kind = 'vat') AS vat_amount,
+                COUNT(*) FILTER (WHERE kind != 'vat') AS expense_line_count
+            FROM (
+                SELECT
+                    aml.move_id,
+                    aml.balance,
+                    aml.vat_prorata_kind AS kind,
+                    aml.vat_prorata_rate * aml.balance AS weight
+                FROM account_move_line aml
+                WHERE aml.move_id IN %(move_ids)s
+                AND aml.vat_prorata_kind IN %(kinds)s
+                AND aml.balance != 0
+            ) lines
+            GROUP BY move_id
+            HAVING bool_or(kind = 'vat')
+            -- same as ccur.is_zero() on the total weight
+            AND NOT COALESCE(ROUND(CAST(
+                SUM(weight) FILTER (WHERE kind = 'other_tax') / %(rounding)s
+                AS numeric)) != 0, false)
+            AND NOT COALESCE(ROUND(CAST(
+                SUM(weight) FILTER (WHERE kind = 'other_notax') / %(rounding)s
+                AS numeric)) != 0, false)
+            ORDER BY move_id
+            """
+        return request, {
+            'move_ids': tuple(move_ids),
+            'kinds': PRORATA_KINDS,
+            'rounding': self.company_id.currency_id.rounding,
+            }
+
+    def check_prorata_anomalies(self):
+        """Pre-flight validation of the source journal entries of the
+        period with a single query. The anomalies are stored in
+        account.vat.prorata.anomaly ; return the number of anomalies."""
+        self.ensure_one()
+        self._sql_delete_children('account.vat.prorata.anomaly')
+        speedy = self._prepare_speed_dict()
+        move_ids = self.env['account.move'].search(
+            self._get_prorata_move_domain()).ids
+        if not move_ids:
+            return 0
+        self.env['account.move.line']._vat_prorata_refresh_kind(
+            self.company_id, speedy, move_ids)
+        self.env['account.move.line'].flush(['move_id', 'balance'])
+        self._cr.execute(*self._get_anomaly_query(move_ids))
+        vals_list = [{
+            'parent_id': self.id,
+            'move_id': move_id,
+            'reason': reason,
+            'vat_amount': vat_amount,
+            'expense_line_count': expense_line_count,
+            } for (move_id, reason, vat_amount, expense_line_count)
+            in self._cr.fetchall()]
+        self.env['account.vat.prorata.anomaly'].create(vals_list)
+        logger.info(
+            'VAT prorata ID %d: %d source journal entries with anomalies',
+            self.id, len(vals_list))
+        return len(vals_list)
+
+    def button_check_anomalies(self):
+        self.ensure_one()
+        if self.check_prorata_anomalies():
+            return self.button_anomaly_tree()
+        self.message_post(body=_(
+            "No anomaly found in the source journal entries."))
+        return True
+
+    def button_anomaly_tree(self):
+        action = self.env['ir.actions.actions']._for_xml_id(
+            'account_vat_pro_rata.account_vat_prorata_anomaly_action')
+        action['domain'] = [('parent_id', '=', self.id)]
+        return action
+
+    def button_generate_move(self):
+        if not self:
+            return
+        self._check_no_job_in_progress()
+        # pre-flight validation: the generation only runs when all the
+        # source journal entries are valid (not for the consolidation,
+        # which reuses the lines of periods already done)
+        with_anomalies = self.filtered(
+            lambda x: not x.consolidation and x.check_prorata_anomalies())
+        if with_anomalies:
+            if len(self) == 1:
+                return self.button_anomaly_tree()
+            raise UserError(_(
+                "Some source journal entries of the VAT pro rata {proratas} "
+                "have anomalies: use the button 'Check Journal Entries' "
+                "on each VAT pro rata to list them.").format(
+                    proratas=', '.join(with_anomalies.mapped('display_name'))))
+        for rec in self:
+            rec.generate_prorata_lines()
+        stats = {}
+        with self._track_phase(stats, 'move_creation') as tracker:
+            moves_vals = []
+            for rec in self:
+                moves_vals += rec._prepare_moves()
+            moves = self._create_prorata_moves(moves_vals)
+            moves.flush()
+            tracker['rows'] = sum(
+                len(move_vals['line_ids']) for move_vals in moves_vals)
+        self._save_phase_stats(stats)
+        self.write({'state': 'done'})
         # I think it's better to stay on the VAT prorata form view
 #        action = self.env['ir.actions.actions']._for_xml_id(
 #            'account.action_move_journal_line')
@@ -466,6 +1981,112 @@ class AccountVatProrata(models.Model):
 #            })
 #        return action
 
+    def action_batch_compute(self):
+        """Compute the ratio and generate the journal entry of several
+        VAT pro rata records (server action and cron)"""
+        draft_recs = self.filtered(lambda x: x.state == 'draft')
+        if draft_recs:
+            draft_recs.button_compute_ratio()
+        ratio_recs = self.filtered(lambda x: x.state == 'ratio')
+        if ratio_recs:
+            ratio_recs.button_generate_move()
+
+    def action_parallel_compute(self):
+        """Server action: queue the computation of the ratio and the
+        generation of the journal entry of each VAT pro rata record as
+        background jobs, run by the cron of the jobs, so that the HTTP
+        request doesn't wait for them."""
+        self._check_no_job_in_progress()
+        self.env['account.vat.prorata.job']._enqueue(self, 'batch_compute')
+
+    @api.model
+    def _get_parallel_worker_count(self):
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_vat_pro_rata.parallel_workers', 2))
+        # each worker has its own database connection: keep a small
+        # number of them, and some connections for the other requests
+        max_workers = min(PARALLEL_MAX_WORKERS, config['db_maxconn'] - 2)
+        return max(min(workers, max_workers), 1)
+
+    def _parallel_compute(self):
+        """Only for the cron: compute the ratio and generate the journal
+        entry of each VAT pro rata record in its own transaction, in a
+        small pool of threads that each have their own database cursor.
+        The records of the same company are computed one after the other
+        by the same thread, because they write the same company data
+        (classification signature...) and would fail with serialization
+        errors.
+        A failure on a record doesn't roll back the others ; the result
+        is posted in the chatter of each record."""
+        company2ids = defaultdict(list)
+        for rec in self:
+            company2ids[rec.company_id.id].append(rec.id)
+        workers = min(
+            self._get_parallel_worker_count(), len(company2ids)) or 1
+        logger.info(
+            'VAT prorata: starting parallel computation of %d records '
+            'of %d companies with %d workers',
+            len(self), len(company2ids), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [
+                result for company_results in executor.map(
+                    self._parallel_compute_company, company2ids.values())
+                for result in company_results]
+        self.invalidate_cache()
+        failed_ids = [prorata_id for (prorata_id, ok) in results if not ok]
+        logger.info(
+            'VAT prorata: parallel computation finished, %d success, '
+            '%d failures (IDs %s)',
+            len(results) - len(failed_ids), len(failed_ids), failed_ids)
+        return results
+
+    def _parallel_compute_company(self, prorata_ids):
+        return [
+            self._parallel_compute_one(prorata_id)
+            for prorata_id in prorata_ids]
+
+    def _parallel_compute_one(self, prorata_id):
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            rec = env[self._name].browse(prorata_id)
+            try:
+                rec.action_batch_compute()
+                cr.commit()
+            except Exception as e:
+                cr.rollback()
+                env.clear()
+                logger.warning(
+                    'VAT prorata ID %d: computation failed: %s',
+                    prorata_id, e)
+                rec.message_post(body=_(
+                    "Computation of the VAT pro rata failed: %s") % e)
+                return (prorata_id, False)
+            if rec.state != 'done':
+                # stopped by the pre-flight validation
+                rec.message_post(body=_(
+                    "Computation of the VAT pro rata stopped: %d source "
+                    "journal entries with anomalies.") % rec.anomaly_count)
+                cr.commit()
+                return (prorata_id, False)
+            rec.message_post(body=_(
+                "VAT pro rata computed: used ratio %s %%, "
+                "journal entry %s.") % (
+                    rec.used_perct,
+                    ', '.join(rec.move_ids.mapped('display_name'))))
+            return (prorata_id, True)
+
+    @api.model
+    def _cron_batch_compute(self):
+        today = fields.Date.context_today(self)
+        records = self.search([
+            ('state', 'in', ('draft', 'ratio')),
+            ('date_to', '<', today),
+            ])
+        logger.info(
+            'VAT prorata cron: computing %d VAT pro rata records',
+            len(records))
+        records._parallel_compute()
+
     def name_get(self):
         res = []
         for rec in self:
@@ -541,3 +2162,128 @@ class AccountVatProrataLine(models.Model):
         related='line_id.start_date', store=True)
     end_date = fields.Date(
         related='line_id.end_date', store=True)
+
+    # key = stored related field, value = field of account.move.line
+    _line_related_fields = {
+        'date': 'date',
+        'move_id': 'move_id',
+        'account_id': 'account_id',
+        'partner_id': 'partner_id',
+        'ref': 'ref',
+        'label': 'name',
+        'start_date': 'start_date',
+        'end_date': 'end_date',
+        }
+
+    @api.model
+    def _get_create_chunk_size(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_vat_pro_rata.create_chunk_size', 1000))
+
+    @api.model
+    def _bulk_create(self, vals_list):
+        """Create the lines in batches and fill the stored related fields
+        with one UPDATE per batch instead of recomputing them record per
+        record"""
+        chunk_size = self._get_create_chunk_size()
+        line_ids = []
+        for i in range(0, len(vals_list), chunk_size):
+            line_ids += self._create_chunk(vals_list[i:i + chunk_size]).ids
+        return self.browse(line_ids)
+
+    @api.model
+    def _create_chunk(self, vals_list):
+        if not vals_list:
+            return self
+        lines = self.create(vals_list)
+        fnames = list(self._line_related_fields)
+        for fname in fnames:
+            self.env.remove_to_compute(self._fields[fname], lines)
+        self.env['account.move.line'].flush(
+            list(self._line_related_fields.values()))
+        set_sql = ', '.join(
+            '%s = aml.%s' % (fname, src)
+            for (fname, src) in self._line_related_fields.items())
+        self._cr.execute("""
+            UPDATE account_vat_prorata_line avpl
+            SET """ + set_sql + """
+            FROM account_move_line aml
+            WHERE aml.id = avpl.line_id
+            AND avpl.id IN %s
+            """, (tuple(lines.ids), ))
+        lines.invalidate_cache(fnames=fnames, ids=lines.ids)
+        return lines
+
+
+class AccountVatProrataLineSummary(models.Model):
+    _name = 'account.vat.prorata.line.summary'
+    _description = 'VAT Pro Rata lines by account'
+    _order = 'parent_id, account_id'
+
+    parent_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', ondelete='cascade',
+        required=True, index=True)
+    company_currency_id = fields.Many2one(
+        related='parent_id.company_currency_id', string="Company Currency")
+    account_id = fields.Many2one(
+        'account.account', string='Account', readonly=True)
+    line_count = fields.Integer(string='Number of Lines', readonly=True)
+    original_vat_amount = fields.Monetary(
+        string="VAT Amount", currency_field='company_currency_id')
+    prorata_vat_amount = fields.Monetary(
+        string="Pro Rata VAT Amount", currency_field='company_currency_id')
+    counterpart_amount = fields.Monetary(
+        string="Counter-part Amount", currency_field='company_currency_id')
+    original_amount = fields.Monetary(
+        string="Expense Amount", currency_field='company_currency_id')
+
+    def button_prorata_line_tree(self):
+        self.ensure_one()
+        action = self.parent_id.button_prorata_line_tree()
+        action['domain'].append(('account_id', '=', self.account_id.id))
+        return action
+
+
+class AccountVatProrataAnomaly(models.Model):
+    _name = 'account.vat.prorata.anomaly'
+    _description = 'VAT Pro Rata source journal entry with anomaly'
+    _order = 'parent_id, move_id'
+
+    parent_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', ondelete='cascade',
+        required=True, index=True)
+    company_currency_id = fields.Many2one(
+        related='parent_id.company_currency_id', string="Company Currency")
+    move_id = fields.Many2one(
+        'account.move', string='Journal Entry', ondelete='cascade',
+        readonly=True)
+    reason = fields.Selection([
+        ('vat_without_expense', 'Deductible VAT without Expense Line'),
+        ('zero_expense_weight', 'Expense Lines with Zero Weight'),
+        ], required=True, readonly=True)
+    vat_amount = fields.Monetary(
+        string="VAT Amount", currency_field='company_currency_id')
+    expense_line_count = fields.Integer(
+        string='Number of Expense Lines', readonly=True)
+
+
+class AccountVatProrataStat(models.Model):
+    _name = 'account.vat.prorata.stat'
+    _description = 'VAT Pro Rata performance statistics'
+    _order = 'id desc'
+
+    parent_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', ondelete='cascade',
+        required=True, index=True)
+    company_id = fields.Many2one(
+        related='parent_id.company_id', store=True)
+    phase = fields.Selection([
+        ('subject_lines', 'Subject Lines Creation'),
+        ('move_search', 'Move Search'),
+        ('classification', 'Classification'),
+        ('line_creation', 'Lines Creation'),
+        ('move_creation', 'Journal Entry Creation'),
+        ], required=True, readonly=True)
+    duration = fields.Float(string='Duration (s)', digits=(16, 3), readonly=True)
+    query_count = fields.Integer(string='SQL Queries', readonly=True)
+    rows = fields.Integer(string='Rows Processed', readonly=True)
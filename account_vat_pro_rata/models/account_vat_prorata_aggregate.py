@@ -0,0 +1,234 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models
+from odoo.tools import float_round
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AccountVatProrataAggregate(models.Model):
+    """Monthly balance of the income accounts used for the VAT pro rata
+    ratio, by company, journal and state of the journal entries.
+    The table is maintained incrementally: every change of a journal item
+    on an income account or of its journal entry records its bucket
+    (company, journal, month) once in account.vat.prorata.aggregate.dirty ;
+    these buckets are recomputed by _refresh_aggregate().
+    The aggregate is only used for the provisional ratio: the ratio
+    of the VAT pro rata records is always computed from the journal
+    items."""
+    _name = 'account.vat.prorata.aggregate'
+    _description = 'VAT Pro Rata ratio aggregate'
+    _log_access = False
+
+    company_id = fields.Many2one(
+        'res.company', string='Company', required=True, index=True,
+        ondelete='cascade')
+    journal_id = fields.Many2one(
+        'account.journal', string='Journal', required=True,
+        ondelete='cascade')
+    account_id = fields.Many2one(
+        'account.account', string='Income Account', required=True,
+        ondelete='cascade')
+    vat_subject = fields.Selection([
+        ('vat_subject', 'Income VAT Subject'),
+        ('no_vat_subject', 'Income No VAT Subject'),
+        ], string='VAT Subject')
+    month = fields.Date(required=True)
+    state = fields.Char(string='Journal Entry Status')
+    company_currency_id = fields.Many2one(
+        related='company_id.currency_id', string='Company Currency')
+    debit = fields.Monetary(currency_field='company_currency_id')
+    credit = fields.Monetary(currency_field='company_currency_id')
+    balance = fields.Monetary(currency_field='company_currency_id')
+
+    def init(self):
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_vat_prorata_aggregate_bucket_idx
+            ON account_vat_prorata_aggregate (company_id, journal_id, month)
+            """)
+
+    @api.model
+    def _insert_dirty(self, where, params):
+        """Record the buckets of the journal items on income accounts
+        selected by where.
+        A bucket that is already dirty is updated rather than skipped:
+        the new row version makes a concurrent refresh that deletes it
+        fail with a serialization error (and run again), otherwise the
+        refresh could recompute the bucket without the changes of this
+        transaction and delete its dirty row."""
+        self.env['account.move.line'].flush(['move_id', 'account_id'])
+        self.env['account.move'].flush(['company_id', 'journal_id', 'date'])
+        self._cr.execute("""
+            INSERT INTO account_vat_prorata_aggregate_dirty
+                (company_id, journal_id, month)
+            SELECT DISTINCT
+                am.company_id, am.journal_id,
+                date_trunc('month', am.date)::date
+            FROM account_move_line aml
+            JOIN account_account aa ON aa.id = aml.account_id
+            JOIN account_move am ON am.id = aml.move_id
+            JOIN res_company rc ON rc.id = am.company_id
+            WHERE """ + where + """
+            AND aa.vat_subject IS NOT NULL
+            AND rc.vat_prorata IS true
+            ON CONFLICT (company_id, journal_id, month)
+            DO UPDATE SET month = EXCLUDED.month
+            """, params)
+
+    @api.model
+    def _mark_dirty(self, move_ids):
+        """Record the buckets of the journal entries that have journal
+        items on income accounts, before they are moved to another bucket
+        or deleted"""
+        if not move_ids:
+            return
+        self._insert_dirty('aml.move_id IN %s', (tuple(move_ids), ))
+
+    @api.model
+    def _mark_dirty_lines(self, lines):
+        """Record the buckets of the journal items on income accounts"""
+        if not lines:
+            return
+        self._insert_dirty('aml.id IN %s', (tuple(lines.ids), ))
+
+    @api.model
+    def _refresh_buckets(self, company_id, buckets):
+        """Recompute the buckets (journal_id, month) of a company"""
+        if not buckets:
+            return
+        bucket_sql = ', '.join(['(%s, %s::date)'] * len(buckets))
+        bucket_params = [item for bucket in buckets for item in bucket]
+        self._cr.execute("""
+            DELETE FROM account_vat_prorata_aggregate
+            WHERE company_id = %s
+            AND (journal_id, month) IN (VALUES """ + bucket_sql + """)
+            """, [company_id] + bucket_params)
+        self._cr.execute("""
+            INSERT INTO account_vat_prorata_aggregate (
+                company_id, journal_id, account_id, vat_subject, month, state,
+                debit, credit, balance)
+            SELECT
+                am.company_id,
+                am.journal_id,
+                aml.account_id,
+                aa.vat_subject,
+                date_trunc('month', am.date)::date,
+                am.state,
+                SUM(aml.debit),
+                SUM(aml.credit),
+                SUM(aml.balance)
+            FROM account_move_line aml
+            JOIN account_move am ON am.id = aml.move_id
+            JOIN account_account aa ON aa.id = aml.account_id
+            WHERE aa.vat_subject IN ('vat_subject', 'no_vat_subject')
+            AND am.company_id = %s
+            AND (am.journal_id, date_trunc('month', am.date)::date)
+                IN (VALUES """ + bucket_sql + """)
+            GROUP BY
+                am.company_id, am.journal_id, aml.account_id, aa.vat_subject,
+                date_trunc('month', am.date), am.state
+            """, [company_id] + bucket_params)
+
+    @api.model
+    def _refresh_company(self, company):
+        """Full rebuild of the company when it has never been aggregated
+        (or when the VAT subject of an account changed), otherwise
+        refresh of the dirty buckets.
+        Only the dirty rows visible in the transaction are deleted:
+        the rows of transactions that commit after the refresh started
+        are processed by the next refresh."""
+        cr = self._cr
+        now = cr.now()
+        if not company.vat_prorata_aggregate_watermark:
+            cr.execute("""
+                SELECT DISTINCT am.journal_id, date_trunc('month', am.date)::date
+                FROM account_move_line aml
+                JOIN account_move am ON am.id = aml.move_id
+                JOIN account_account aa ON aa.id = aml.account_id
+                WHERE aa.vat_subject IN ('vat_subject', 'no_vat_subject')
+                AND am.company_id = %s
+                """, (company.id, ))
+            buckets = set(cr.fetchall())
+            cr.execute(
+                "DELETE FROM account_vat_prorata_aggregate "
+                "WHERE company_id = %s", (company.id, ))
+        else:
+            cr.execute("""
+                SELECT DISTINCT journal_id, month
+                FROM account_vat_prorata_aggregate_dirty
+                WHERE company_id = %s
+                """, (company.id, ))
+            buckets = set(cr.fetchall())
+        cr.execute(
+            "DELETE FROM account_vat_prorata_aggregate_dirty "
+            "WHERE company_id = %s", (company.id, ))
+        self._refresh_buckets(company.id, sorted(buckets))
+        company.write({'vat_prorata_aggregate_watermark': now})
+        logger.debug(
+            'VAT prorata aggregate of company %s: %d buckets refreshed',
+            company.display_name, len(buckets))
+
+    @api.model
+    def _refresh_aggregate(self, companies=None):
+        if companies is None:
+            companies = self.env['res.company'].search(
+                [('vat_prorata', '=', True)])
+        self.env['account.move.line'].flush()
+        self.env['account.move'].flush()
+        self.env['account.account'].flush(['vat_subject'])
+        for company in companies:
+            self._refresh_company(company)
+        self.invalidate_cache()
+
+    @api.model
+    def _cron_refresh_aggregate(self):
+        self._refresh_aggregate()
+
+    @api.model
+    def _get_ratio(self, company, date_from, date_to, journals, target_move):
+        """Return the VAT subject ratio from the aggregate, without
+        refreshing it. date_from and date_to must be the first and last
+        day of a month."""
+        domain = [
+            ('company_id', '=', company.id),
+            ('journal_id', 'in', journals.ids),
+            ('month', '>=', date_from),
+            ('month', '<=', date_to),
+            ]
+        if target_move == 'posted':
+            domain.append(('state', '=', 'posted'))
+        total = 0.0
+        vat_subject_total = 0.0
+        for group in self.read_group(
+                domain, ['vat_subject', 'balance'], ['vat_subject']):
+            total += group['balance']
+            if group['vat_subject'] == 'vat_subject':
+                vat_subject_total += group['balance']
+        perct_prec = self.env['decimal.precision'].precision_get(
+            'VAT Pro Rata Ratio')
+        if not total:
+            return 0.0
+        return float_round(
+            100 * vat_subject_total / total, precision_digits=perct_prec)
+
+
+class AccountVatProrataAggregateDirty(models.Model):
+    """Buckets of the VAT pro rata aggregate to recompute"""
+    _name = 'account.vat.prorata.aggregate.dirty'
+    _description = 'VAT Pro Rata ratio aggregate buckets to refresh'
+    _log_access = False
+    _sql_constraints = [(
+        'bucket_uniq',
+        'unique(company_id, journal_id, month)',
+        'This bucket of the VAT pro rata aggregate is already dirty.'
+        )]
+
+    company_id = fields.Many2one(
+        'res.company', string='Company', required=True, index=True,
+        ondelete='cascade')
+    journal_id = fields.Many2one(
+        'account.journal', string='Journal', required=True,
+        ondelete='cascade')
+    month = fields.Date(required=True)
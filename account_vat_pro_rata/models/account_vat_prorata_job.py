@@ -0,0 +1,225 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from datetime import timedelta
+from .account_vat_prorata import MOVE_CHUNK_SIZE
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AccountVatProrataJob(models.Model):
+    """Queue of the VAT pro rata computations run in background by a cron.
+
+    The job rows are only updated in short separate transactions (claim,
+    progress, result), so that the progress is visible while the
+    computation runs in its own transaction."""
+    _name = 'account.vat.prorata.job'
+    _description = 'VAT Pro Rata background job'
+    _order = 'id desc'
+
+    prorata_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', required=True,
+        ondelete='cascade', index=True, readonly=True)
+    company_id = fields.Many2one(
+        related='prorata_id.company_id', store=True)
+    action = fields.Selection([
+        ('compute_ratio', 'Compute Ratio'),
+        ('generate_move', 'Generate Pro Rata Lines and Journal Entry'),
+        ('batch_compute', 'Compute Ratio and Generate Journal Entry'),
+        ], required=True, readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+        ], default='queued', required=True, index=True, readonly=True)
+    progress_done = fields.Integer(string='Moves Processed', readonly=True)
+    progress_total = fields.Integer(string='Total Moves', readonly=True)
+    progress = fields.Float(
+        compute='_compute_progress', string='Progress (%)')
+    date_start = fields.Datetime(string='Start', readonly=True)
+    date_end = fields.Datetime(string='End', readonly=True)
+    error = fields.Text(readonly=True)
+
+    @api.depends('state', 'progress_done', 'progress_total')
+    def _compute_progress(self):
+        for job in self:
+            progress = 0.0
+            if job.state == 'done':
+                progress = 100.0
+            elif job.progress_total:
+                progress = 100.0 * job.progress_done / job.progress_total
+            job.progress = progress
+
+    @api.model
+    def _update_job(self, job_id, vals):
+        """Update the job in a separate transaction, committed at once"""
+        set_sql = ', '.join('%s = %%s' % fname for fname in vals)
+        with self.pool.cursor() as cr:
+            cr.execute(
+                "UPDATE account_vat_prorata_job SET " + set_sql +
+                " WHERE id = %s", list(vals.values()) + [job_id])
+
+    @api.model
+    def _get_dead_job_grace(self):
+        # delay between the claim of the job and the lock of the VAT pro
+        # rata record by _run_job()
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'account_vat_pro_rata.job_grace_seconds', 60))
+
+    def _fail_dead_jobs(self):
+        """Mark as failed the running jobs whose worker is gone (killed by
+        limit_time_real_cron, out of memory...). _run_job() locks the
+        VAT pro rata record during the whole computation, so if the record
+        is not locked, nobody is running the job.
+        Return the IDs of the dead jobs. As the jobs are updated in
+        separate transactions, the current transaction still sees them
+        as running: the caller must use the returned IDs."""
+        limit = fields.Datetime.now() - timedelta(
+            seconds=self._get_dead_job_grace())
+        dead_ids = []
+        for job in self.filtered(lambda x: x.state == 'running'):
+            if job.date_start and job.date_start > limit:
+                continue
+            with self.pool.cursor() as cr:
+                cr.execute(
+                    "SELECT id FROM account_vat_prorata WHERE id = %s "
+                    "FOR UPDATE SKIP LOCKED", (job.prorata_id.id, ))
+                if cr.fetchone():
+                    dead_ids.append(job.id)
+        for job_id in dead_ids:
+            logger.warning(
+                'VAT prorata job %d: the worker is gone, job marked as '
+                'failed', job_id)
+            self._update_job(job_id, {
+                'state': 'failed',
+                'error': _("The background worker was interrupted."),
+                'date_end': fields.Datetime.now(),
+                })
+        return dead_ids
+
+    def button_cancel(self):
+        dead_ids = self._fail_dead_jobs()
+        for job in self:
+            if job.state == 'running' and job.id not in dead_ids:
+                raise UserError(_(
+                    "The background computation of %s is running, "
+                    "it can't be cancelled.") % job.prorata_id.display_name)
+        with self.pool.cursor() as cr:
+            # the job may have been claimed in the meantime
+            cr.execute("""
+                UPDATE account_vat_prorata_job
+                SET state = 'cancelled', date_end = now() at time zone 'UTC'
+                WHERE id IN %s AND state = 'queued'
+                """, (tuple(self.ids), ))
+        self.invalidate_cache()
+
+    @api.model
+    def _claim_next_job(self):
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE account_vat_prorata_job
+                SET state = 'running',
+                    date_start = now() at time zone 'UTC'
+                WHERE id = (
+                    SELECT id FROM account_vat_prorata_job
+                    WHERE state = 'queued'
+                    ORDER BY id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED)
+                RETURNING id
+                """)
+            row = cr.fetchone()
+        return row and row[0] or False
+
+    @api.model
+    def _run_job(self, job_id):
+        with self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, dict(
+                self.env.context, vat_prorata_job_id=job_id,
+                vat_prorata_move_chunk_size=self._get_job_move_chunk_size()))
+            job = env[self._name].browse(job_id)
+            prorata = job.prorata_id
+            try:
+                # fails at once if the record is being computed
+                # interactively
+                cr.execute(
+                    "SELECT id FROM account_vat_prorata WHERE id = %s "
+                    "FOR UPDATE NOWAIT", (prorata.id, ))
+                if job.action == 'compute_ratio':
+                    prorata.button_compute_ratio()
+                elif job.action == 'batch_compute':
+                    prorata.action_batch_compute()
+                else:
+                    prorata.button_generate_move()
+                cr.commit()
+                if (
+                        job.action in ('generate_move', 'batch_compute') and
+                        prorata.state != 'done'):
+                    # stopped by the pre-flight validation, the anomalies
+                    # have been committed
+                    self._update_job(job_id, {
+                        'state': 'failed',
+                        'error': _(
+                            "%d source journal entries with anomalies.")
+                        % prorata.anomaly_count,
+                        'date_end': fields.Datetime.now(),
+                        })
+                    return False
+            except Exception as e:
+                cr.rollback()
+                logger.warning(
+                    'VAT prorata job %d on VAT prorata ID %d failed: %s',
+                    job_id, prorata.id, e)
+                self._update_job(job_id, {
+                    'state': 'failed',
+                    'error': str(e),
+                    'date_end': fields.Datetime.now(),
+                    })
+                return False
+        self._update_job(job_id, {
+            'state': 'done',
+            'date_end': fields.Datetime.now(),
+            })
+        return True
+
+    @api.model
+    def _get_job_move_chunk_size(self):
+        # the progress is reported after each chunk of moves
+        return self.env['account.vat.prorata']._get_move_chunk_size() or \
+            MOVE_CHUNK_SIZE
+
+    @api.model
+    def _cron_run_jobs(self, limit=10):
+        self.search([('state', '=', 'running')])._fail_dead_jobs()
+        for i in range(limit):
+            job_id = self._claim_next_job()
+            if not job_id:
+                break
+            self._run_job(job_id)
+
+    @api.model
+    def _report_progress(self, done, total):
+        job_id = self._context.get('vat_prorata_job_id')
+        if job_id:
+            self._update_job(job_id, {
+                'progress_done': done,
+                'progress_total': total,
+                })
+
+    @api.model
+    def _enqueue(self, proratas, action):
+        jobs = self.create([
+            {'prorata_id': prorata.id, 'action': action}
+            for prorata in proratas])
+        for prorata in proratas:
+            prorata.message_post(body=_(
+                "%s queued for background computation.")
+                % dict(self._fields['action'].selection)[action])
+        self.env.ref(
+            'account_vat_pro_rata.account_vat_prorata_job_cron')._trigger()
+        return jobs
@@ -8,43 +8,121 @@ from odoo.tools.misc import format_date, format_amount
 from odoo.tools import float_compare, float_round
 
 
+class VatProrataLogNote(object):
+    """Note of a log of VAT on payment adjusted by the VAT pro rata.
+    The raw ratio and amount are kept ; the note is only formatted when
+    it is converted to a string, i.e. when the log is rendered."""
+    __slots__ = ('note', 'suffix', 'ratio', 'amount', 'env', 'currency')
+
+    def __init__(self, note, suffix, ratio, amount, env, currency):
+        self.note = note
+        self.suffix = suffix
+        self.ratio = ratio
+        self.amount = amount
+        self.env = env
+        self.currency = currency
+
+    def __str__(self):
+        return '%s%s' % (self.note, self.suffix.format(
+            ratio=self.ratio,
+            vat_amount=format_amount(self.env, self.amount, self.currency)))
+
+    def __add__(self, other):
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+
 class L10nFrAccountVatReturn(models.Model):
     _inherit = 'l10n.fr.account.vat.return'
 
-    def _vat_on_payment(self, in_or_out, vat_account_ids, speedy):
-        account2logs = super()._vat_on_payment(in_or_out, vat_account_ids, speedy)
-        if in_or_out == 'in' and self.company_id.vat_prorata:
+    def _get_vat_prorata_ratios(self):
+        """Return a dict with key = VAT return ID and value = VAT prorata
+        ratio, for the VAT returns of companies with VAT prorata.
+        The VAT prorata records of all the VAT returns are read with
+        a single search, so that it can be used to precompute the ratios
+        of a multi-company batch of VAT returns, via the context key
+        'vat_prorata_ratios'."""
+        vat_returns = self.filtered(lambda x: x.company_id.vat_prorata)
+        if not vat_returns:
+            return {}
+        # the annual consolidation has the same end date as the last
+        # period of the year: the VAT return uses the period record
+        domain = [('consolidation', '=', False)]
+        domain += ['|'] * (len(vat_returns) - 1)
+        for vat_return in vat_returns:
+            domain += [
+                '&',
+                ('company_id', '=', vat_return.company_id.id),
+                ('date_to', '=', vat_return.end_date),
+                ]
+        key2prorata = {}
+        for prorata in self.env['account.vat.prorata'].search(domain):
+            key2prorata.setdefault(
+                (prorata.company_id.id, prorata.date_to), prorata)
+        perct_prec = self.env['decimal.precision'].precision_get(
+            'VAT Pro Rata Ratio')
+        res = {}
+        for vat_return in vat_returns:
             # make sure VAT prorata already exists for that period
-            prorata = self.env['account.vat.prorata'].search([
-                ('company_id', '=', speedy['company_id']),
-                ('date_to', '=', self.end_date)
-                ], limit=1)
+            prorata = key2prorata.get(
+                (vat_return.company_id.id, vat_return.end_date))
             if not prorata:
                 raise UserError(_(
                     "There is no VAT prorata in company '{company}' "
                     "for the period that ends on {end_date}.").format(
-                        company=self.company_id.display_name,
-                        end_date=format_date(self.env, self.end_date)))
-            if prorata and prorata.state != 'done':
+                        company=vat_return.company_id.display_name,
+                        end_date=format_date(self.env, vat_return.end_date)))
+            if prorata.state != 'done':
                 raise UserError(_(
                     "You must finish the VAT prorata process in company "
                     "'{company}' for the period that ends on {end_date} "
                     "before doing the VAT return for the same period.").format(
-                        company=self.company_id.display_name,
-                        end_date=format_date(self.env, self.end_date)))
-            perct_prec = self.env['decimal.precision'].precision_get(
-                'VAT Pro Rata Ratio')
+                        company=vat_return.company_id.display_name,
+                        end_date=format_date(self.env, vat_return.end_date)))
             ratio = float_round(prorata.used_perct, precision_digits=perct_prec)
             assert float_compare(ratio, 100, precision_digits=perct_prec) <= 0
             assert float_compare(ratio, 0, precision_digits=perct_prec) >= 0
-            if float_compare(ratio, 100, precision_digits=perct_prec) < 0:
-                for account, logs in account2logs.items():
-                    for log in logs:
-                        log['amount'] *= ratio / 100
-                        log['note'] += _(
-                            " => VAT prorata ratio {ratio} % "
-                            "VAT amount: {vat_amount}").format(
-                                ratio=ratio,
-                                vat_amount=format_amount(
-                                    self.env, log['amount'], speedy["currency"]))
+            res[vat_return.id] = ratio
+        return res
+
+    def _get_vat_prorata_ratio(self, speedy):
+        """Ratio of the VAT return, resolved once per VAT return and
+        stored in speedy"""
+        if 'vat_prorata_ratio' not in speedy:
+            ratios = self._context.get('vat_prorata_ratios')
+            if ratios is None or self.id not in ratios:
+                ratios = self._get_vat_prorata_ratios()
+            speedy['vat_prorata_ratio'] = ratios[self.id]
+        return speedy['vat_prorata_ratio']
+
+    def _vat_prorata_adjust_logs(self, account2logs, ratio, speedy):
+        """Apply the ratio on all the logs in one pass. The suffix of the
+        note is translated once ; the notes are formatted lazily, when
+        the logs are rendered (cf VatProrataLogNote)."""
+        factor = ratio / 100
+        note_suffix = _(
+            " => VAT prorata ratio {ratio} % VAT amount: {vat_amount}")
+        currency = speedy["currency"]
+        for logs in account2logs.values():
+            for log in logs:
+                amount = log['amount'] * factor
+                log['amount'] = amount
+                log['vat_prorata_ratio'] = ratio
+                log['note'] = VatProrataLogNote(
+                    log['note'], note_suffix, ratio, amount, self.env,
+                    currency)
+
+    def _vat_on_payment(self, in_or_out, vat_account_ids, speedy):
+        account2logs = super()._vat_on_payment(in_or_out, vat_account_ids, speedy)
+        if in_or_out == 'in' and self.company_id.vat_prorata:
+            ratio = self._get_vat_prorata_ratio(speedy)
+            if 'vat_prorata_perct_prec' not in speedy:
+                speedy['vat_prorata_perct_prec'] = self.env[
+                    'decimal.precision'].precision_get('VAT Pro Rata Ratio')
+            if float_compare(
+                    ratio, 100,
+                    precision_digits=speedy['vat_prorata_perct_prec']) < 0:
+                self._vat_prorata_adjust_logs(account2logs, ratio, speedy)
         return account2logs
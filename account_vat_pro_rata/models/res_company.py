@@ -3,6 +3,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
 
 from odoo import fields, models
+from dateutil.relativedelta import relativedelta
 
 
 class ResCompany(models.Model):
@@ -12,3 +13,41 @@ class ResCompany(models.Model):
     vat_prorata_journal_id = fields.Many2one(
         'account.journal', string='Default VAT Pro Rata Journal',
         copy=False, check_company=True)
+    vat_prorata_engine = fields.Selection([
+        ('sql', 'SQL'),
+        ('python', 'Python (reference)'),
+        ], string='VAT Pro Rata Engine', default='sql', required=True,
+        help="Engine used to classify the journal items when generating "
+        "the VAT Pro Rata lines. The SQL engine classifies all the journal "
+        "items in a single query ; the Python engine reads the journal "
+        "entries one by one via the ORM and is kept as reference.")
+    vat_prorata_trace = fields.Boolean(
+        string='Trace VAT Pro Rata Computations',
+        help="If enabled, the classification of each journal entry is "
+        "recorded when generating the VAT Pro Rata lines and attached "
+        "as a CSV file to the VAT Pro Rata.")
+    vat_prorata_aggregate_watermark = fields.Datetime(
+        string='Last Refresh of the VAT Pro Rata Aggregate', readonly=True,
+        copy=False)
+    # configuration used for the classification of the journal items
+    # cf account.move.line _vat_prorata_classify()
+    vat_prorata_kind_signature = fields.Char(readonly=True, copy=False)
+    vat_prorata_provisional_perct = fields.Float(
+        compute='_compute_vat_prorata_provisional_perct',
+        string='Year-to-date Provisional VAT Pro Rata Ratio',
+        digits='VAT Pro Rata Ratio')
+
+    def _compute_vat_prorata_provisional_perct(self):
+        avpao = self.env['account.vat.prorata.aggregate']
+        ajo = self.env['account.journal']
+        today = fields.Date.context_today(self)
+        date_from = today + relativedelta(month=1, day=1)
+        date_to = today + relativedelta(day=31)
+        for company in self:
+            perct = 0.0
+            if company.vat_prorata:
+                sale_journals = ajo.search([
+                    ('type', '=', 'sale'), ('company_id', '=', company.id)])
+                perct = avpao._get_ratio(
+                    company, date_from, date_to, sale_journals, 'posted')
+            company.vat_prorata_provisional_perct = perct
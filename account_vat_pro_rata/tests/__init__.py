@@ -0,0 +1,11 @@
+from . import test_ratio_query
+from . import test_engines
+from . import test_simulation
+from . import test_incremental
+from . import test_aggregate
+from . import test_benchmark
+from . import test_move_split
+from . import test_job
+from . import test_consolidation
+from . import test_audit_export
+from . import test_anomaly
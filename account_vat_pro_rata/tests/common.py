@@ -0,0 +1,169 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests.common import SavepointCase
+from datetime import date
+
+
+class VatProrataCommon(SavepointCase):
+
+    @classmethod
+    def _create_vat_prorata_company(cls, name, tax_rates):
+        """Create a company with the accounts, taxes and journals needed
+        by the VAT pro rata, without chart of accounts.
+        Return a dict"""
+        env = cls.env
+        aao = env['account.account']
+        company = env['res.company'].create({
+            'name': name,
+            'currency_id': env.ref('base.EUR').id,
+            'vat_prorata': True,
+            })
+        env.user.write({'company_ids': [(4, company.id)]})
+
+        def create_account(code, xmlid, vat_subject=False):
+            return aao.create({
+                'code': code,
+                'name': '%s %s' % (name, code),
+                'user_type_id': env.ref(xmlid).id,
+                'reconcile': xmlid in (
+                    'account.data_account_type_payable',
+                    'account.data_account_type_receivable'),
+                'vat_subject': vat_subject,
+                'company_id': company.id,
+                })
+        data = {
+            'company': company,
+            'expense_accounts': [
+                create_account(
+                    '60%04d' % i, 'account.data_account_type_expenses')
+                for i in range(10)],
+            'vat_account': create_account(
+                '445660', 'account.data_account_type_current_assets'),
+            'payable_account': create_account(
+                '401000', 'account.data_account_type_payable'),
+            'receivable_account': create_account(
+                '411000', 'account.data_account_type_receivable'),
+            'vat_subject_account': create_account(
+                '706000', 'account.data_account_type_revenue',
+                'vat_subject'),
+            'no_vat_subject_account': create_account(
+                '768000', 'account.data_account_type_other_income',
+                'no_vat_subject'),
+            'taxes': {},
+            }
+        for rate in tax_rates:
+            if not rate:
+                continue
+            rep_lines = [
+                (0, 0, {'repartition_type': 'base', 'factor_percent': 100}),
+                (0, 0, {
+                    'repartition_type': 'tax',
+                    'factor_percent': 100,
+                    'account_id': data['vat_account'].id}),
+                ]
+            data['taxes'][rate] = env['account.tax'].create({
+                'name': '%s purchase VAT %s %%' % (name, rate),
+                'type_tax_use': 'purchase',
+                'amount_type': 'percent',
+                'amount': rate,
+                'company_id': company.id,
+                'invoice_repartition_line_ids': rep_lines,
+                'refund_repartition_line_ids': rep_lines,
+                })
+        ajo = env['account.journal']
+        data['purchase_journal'] = ajo.create({
+            'name': '%s Purchases' % name, 'code': 'TPUR',
+            'type': 'purchase', 'company_id': company.id})
+        data['sale_journal'] = ajo.create({
+            'name': '%s Sales' % name, 'code': 'TSAL',
+            'type': 'sale', 'company_id': company.id})
+        data['prorata_journal'] = ajo.create({
+            'name': '%s VAT Pro Rata' % name, 'code': 'TPRO',
+            'type': 'general', 'company_id': company.id})
+        return data
+
+    @classmethod
+    def _create_vat_prorata(cls, data, date_from, date_to, **vals):
+        company = data['company']
+        return cls.env['account.vat.prorata'].with_company(company).create(
+            dict({
+                'company_id': company.id,
+                'date_from': date_from,
+                'date_to': date_to,
+                'journal_id': data['prorata_journal'].id,
+                'source_journal_ids': [
+                    (6, 0, data['purchase_journal'].ids)],
+                'ratio_source_journal_ids': [
+                    (6, 0, data['sale_journal'].ids)],
+                'move_label': 'VAT Pro Rata Test',
+                }, **vals))
+
+    @classmethod
+    def _create_purchase_move(
+            cls, data, expense_lines, vat_amount, move_date=date(2021, 6, 15)):
+        """Create and post a purchase journal entry.
+        expense_lines: list of tuples (account, amount, taxes)"""
+        line_vals = []
+        total = 0.0
+        for account, amount, taxes in expense_lines:
+            lvals = {
+                'account_id': account.id,
+                'name': 'Expense',
+                'debit': amount > 0 and amount or 0.0,
+                'credit': amount < 0 and -amount or 0.0,
+                }
+            if taxes:
+                lvals['tax_ids'] = [(6, 0, taxes.ids)]
+            line_vals.append((0, 0, lvals))
+            total += amount
+        line_vals.append((0, 0, {
+            'account_id': data['vat_account'].id,
+            'name': 'VAT',
+            'debit': vat_amount > 0 and vat_amount or 0.0,
+            'credit': vat_amount < 0 and -vat_amount or 0.0,
+            }))
+        total = round(total + vat_amount, 2)
+        line_vals.append((0, 0, {
+            'account_id': data['payable_account'].id,
+            'name': 'Supplier',
+            'debit': total < 0 and -total or 0.0,
+            'credit': total > 0 and total or 0.0,
+            }))
+        move = cls.env['account.move'].with_company(
+            data['company']).with_context(check_move_validity=False).create({
+                'journal_id': data['purchase_journal'].id,
+                'date': move_date,
+                'line_ids': line_vals,
+                })
+        move.action_post()
+        return move
+
+    @classmethod
+    def _create_sale_move(
+            cls, data, amount, account=None, move_date=date(2021, 6, 15),
+            post=True):
+        """Create a sale journal entry on an income account (by default
+        the VAT subject income account)"""
+        if account is None:
+            account = data['vat_subject_account']
+        move = cls.env['account.move'].with_company(data['company']).create({
+            'journal_id': data['sale_journal'].id,
+            'date': move_date,
+            'line_ids': [
+                (0, 0, {
+                    'account_id': data['receivable_account'].id,
+                    'name': 'Customer',
+                    'debit': amount,
+                    }),
+                (0, 0, {
+                    'account_id': account.id,
+                    'name': 'Income',
+                    'credit': amount,
+                    }),
+                ],
+            })
+        if post:
+            move.action_post()
+        return move
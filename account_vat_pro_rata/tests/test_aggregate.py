@@ -0,0 +1,47 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestAggregate(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Aggregate', [20.0])
+
+    def _get_dirty_buckets(self):
+        self.env.cr.execute("""
+            SELECT journal_id, month
+            FROM account_vat_prorata_aggregate_dirty
+            WHERE company_id = %s
+            ORDER BY journal_id, month
+            """, (self.data['company'].id, ))
+        return self.env.cr.fetchall()
+
+    def test_no_dirty_bucket_without_income(self):
+        data = self.data
+        self._create_purchase_move(data, [
+            (data['expense_accounts'][0], 100.0, data['taxes'][20.0]),
+            ], 20.0)
+        self.assertEqual(self._get_dirty_buckets(), [])
+
+    def test_dirty_bucket_once(self):
+        data = self.data
+        moves = self._create_sale_move(data, 100.0, post=False)
+        moves |= self._create_sale_move(data, 50.0, post=False)
+        moves.action_post()
+        moves.button_draft()
+        moves.action_post()
+        buckets = self._get_dirty_buckets()
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual(buckets[0][0], data['sale_journal'].id)
+        self.env['account.vat.prorata.aggregate']._refresh_aggregate(
+            data['company'])
+        self.assertEqual(self._get_dirty_buckets(), [])
@@ -0,0 +1,101 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from odoo.exceptions import UserError
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestAnomaly(VatProrataCommon):
+    """The pre-flight validation must report exactly the source journal
+    entries that the generation of the VAT pro rata lines rejects"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Anomaly', [20.0, 10.0])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        cls.valid_moves = cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], 50.0, False),
+            ], 20.0)
+        # the weight of the lines with tax is zero, but not the weight
+        # of the lines without tax
+        cls.valid_moves |= cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], -100.0, taxes[20.0]),
+            (expense[2], 50.0, False),
+            ], 5.0)
+        # no VAT: ignored
+        cls.valid_moves |= cls._create_purchase_move(data, [
+            (expense[3], 80.0, False),
+            ], 0.0)
+        cls.vat_without_expense_move = cls._create_purchase_move(
+            data, [], 10.0)
+        cls.zero_weight_move = cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], -100.0, taxes[20.0]),
+            ], 5.0, move_date=date(2021, 9, 1))
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31),
+            state='ratio', used_perct=45.0)
+
+    def _is_rejected(self, move, engine):
+        """Return True if the generation of the VAT pro rata lines
+        fails on this journal entry"""
+        prorata = self.prorata
+        speedy = prorata._prepare_speed_dict()
+        try:
+            if engine == 'python':
+                prorata._prepare_prorata_lines(
+                    prorata._prorata_work_moves_python(move, speedy),
+                    speedy['currency'])
+            else:
+                prorata._prepare_prorata_lines_from_columns(
+                    prorata._prorata_columns_sql(move.ids, speedy), speedy)
+        except UserError:
+            return True
+        return False
+
+    def test_anomalies_match_generation(self):
+        prorata = self.prorata
+        self.assertEqual(prorata.check_prorata_anomalies(), 2)
+        self.assertEqual(
+            {(x.move_id, x.reason) for x in prorata.anomaly_ids}, {
+                (self.vat_without_expense_move, 'vat_without_expense'),
+                (self.zero_weight_move, 'zero_expense_weight'),
+                })
+        anomaly_moves = prorata.anomaly_ids.mapped('move_id')
+        moves = self.env['account.move'].search(
+            prorata._get_prorata_move_domain())
+        self.assertEqual(
+            moves,
+            self.valid_moves | self.vat_without_expense_move |
+            self.zero_weight_move)
+        for engine in ('python', 'sql'):
+            for move in moves:
+                self.assertEqual(
+                    self._is_rejected(move, engine), move in anomaly_moves,
+                    '%s engine, move %s' % (engine, move.display_name))
+
+    def test_generation_blocked(self):
+        prorata = self.prorata
+        action = prorata.button_generate_move()
+        self.assertEqual(action['domain'], [('parent_id', '=', prorata.id)])
+        self.assertEqual(prorata.state, 'ratio')
+        self.assertEqual(prorata.anomaly_count, 2)
+        self.assertFalse(prorata.move_ids)
+        bad_moves = prorata.anomaly_ids.mapped('move_id')
+        bad_moves.button_draft()
+        bad_moves.with_context(force_delete=True).unlink()
+        prorata.button_generate_move()
+        prorata.invalidate_cache()
+        self.assertEqual(prorata.state, 'done')
+        self.assertEqual(prorata.anomaly_count, 0)
+        self.assertTrue(prorata.move_ids)
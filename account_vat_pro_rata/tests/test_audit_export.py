@@ -0,0 +1,87 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from datetime import date
+import csv
+import io
+import unittest
+
+from .common import VatProrataCommon
+from ..models.account_vat_prorata import xlsxwriter
+
+
+@tagged('post_install', '-at_install')
+class TestAuditExport(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Audit', [20.0, 10.0])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        cls.moves = cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], 33.33, taxes[10.0]),
+            ], 23.33)
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[2], 45.67, False),
+            ], 9.13, move_date=date(2021, 8, 1))
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31), used_perct=37.5)
+        cls.prorata.generate_prorata_lines()
+
+    def _get_attachment(self, filename):
+        attachment = self.env['ir.attachment'].search([
+            ('res_model', '=', 'account.vat.prorata'),
+            ('res_id', '=', self.prorata.id),
+            ('name', '=', filename),
+            ])
+        self.assertEqual(len(attachment), 1)
+        self.assertEqual(attachment.mimetype, 'application/octet-stream')
+        return attachment
+
+    def _read_csv(self, section):
+        attachment = self._get_attachment(
+            'vat_prorata_audit_%s_2021-01-01_2021-12-31.csv' % section)
+        rows = list(csv.reader(
+            io.StringIO(attachment.raw.decode('utf-8')), delimiter=';'))
+        return rows[0], rows[1:]
+
+    def test_export_csv(self):
+        prorata = self.prorata
+        self.assertTrue(prorata.export_audit_file('csv'))
+        header, rows = self._read_csv('lines')
+        self.assertEqual(len(header), 11)
+        self.assertEqual(len(rows), len(prorata.line_ids))
+        self.assertEqual(
+            {row[0] for row in rows}, set(self.moves.mapped('name')))
+        self.assertEqual(
+            sorted(float(row[10]) for row in rows if float(row[10])),
+            sorted(
+                x for x in prorata.line_ids.mapped('prorata_vat_amount')
+                if x))
+        self.assertAlmostEqual(
+            sum(float(row[8]) for row in rows),
+            sum(prorata.line_ids.mapped('counterpart_amount')))
+        header, rows = self._read_csv('moves')
+        self.assertEqual(len(header), 5)
+        self.assertEqual(
+            [row[0] for row in rows], self.moves.sorted('id').mapped('name'))
+        for row in rows:
+            # the pro rata VAT is fully allocated on the expense lines
+            self.assertAlmostEqual(float(row[2]), float(row[3]))
+            self.assertAlmostEqual(float(row[4]), 0.0)
+        self.assertAlmostEqual(
+            sum(float(row[2]) for row in rows),
+            sum(prorata.line_ids.mapped('prorata_vat_amount')))
+
+    @unittest.skipIf(xlsxwriter is None, 'xlsxwriter is not installed')
+    def test_export_xlsx(self):
+        self.assertTrue(self.prorata.export_audit_file('xlsx'))
+        attachment = self._get_attachment(
+            'vat_prorata_audit_2021-01-01_2021-12-31.xlsx')
+        # zip archive
+        self.assertEqual(attachment.raw[:2], b'PK')
@@ -0,0 +1,190 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import fields
+from odoo.tests import tagged
+from dateutil.relativedelta import relativedelta
+from contextlib import contextmanager
+import random
+import time
+import tracemalloc
+import logging
+
+from .common import VatProrataCommon
+
+logger = logging.getLogger(__name__)
+
+
+@tagged('vat_prorata_benchmark', '-standard', '-at_install')
+class TestVatProrataBenchmark(VatProrataCommon):
+    """Benchmark of the VAT pro rata engine on a synthetic ledger.
+    Not run by default, run it on a local database with:
+
+        odoo -d db -u account_vat_pro_rata --test-enable \\
+            --test-tags vat_prorata_benchmark
+
+    The size of the ledger is set by the class attributes below."""
+    companies = 1
+    moves = 1000
+    lines_per_move = 3
+    tax_mix = {20.0: 0.7, 10.0: 0.1, 5.5: 0.15, 0: 0.05}
+    sale_moves = 200
+    vat_subject_share = 0.75
+    engines = ('sql', 'python')
+    seed = 42
+
+    @contextmanager
+    def _measure(self, report, phase, rows):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        report.append({
+            'phase': phase,
+            'duration': duration,
+            'rows': rows,
+            'rows_per_second': duration and rows / duration or 0.0,
+            'peak_memory_kb': peak // 1024,
+            })
+        logger.info(
+            'VAT prorata benchmark: %s: %.3f s, %d rows, %.0f rows/s, '
+            'peak memory %d KB', phase, duration, rows,
+            duration and rows / duration or 0.0, peak // 1024)
+
+    def _generate_ledger(self, data, date_from, date_to, rnd):
+        amo = self.env['account.move'].with_company(
+            data['company']).with_context(check_move_validity=False)
+        days = (date_to - date_from).days
+        rates = list(self.tax_mix)
+        weights = [self.tax_mix[rate] for rate in rates]
+        batch = []
+        for i in range(self.moves):
+            date = date_from + relativedelta(days=rnd.randint(0, days))
+            line_vals = []
+            total = 0.0
+            vat_total = 0.0
+            for j in range(self.lines_per_move):
+                amount = round(rnd.uniform(1, 5000), 2)
+                rate = rnd.choices(rates, weights)[0]
+                lvals = {
+                    'account_id': rnd.choice(data['expense_accounts']).id,
+                    'name': 'Expense %d-%d' % (i, j),
+                    'debit': amount,
+                    }
+                if rate:
+                    lvals['tax_ids'] = [(6, 0, [data['taxes'][rate].id])]
+                    vat_total += round(amount * rate / 100, 2)
+                line_vals.append((0, 0, lvals))
+                total += amount
+            if vat_total:
+                line_vals.append((0, 0, {
+                    'account_id': data['vat_account'].id,
+                    'name': 'VAT',
+                    'debit': round(vat_total, 2),
+                    }))
+            line_vals.append((0, 0, {
+                'account_id': data['payable_account'].id,
+                'name': 'Supplier',
+                'credit': round(total + vat_total, 2),
+                }))
+            batch.append({
+                'journal_id': data['purchase_journal'].id,
+                'date': date,
+                'line_ids': line_vals,
+                })
+            if len(batch) >= 500:
+                amo.create(batch)
+                batch = []
+        for i in range(self.sale_moves):
+            date = date_from + relativedelta(days=rnd.randint(0, days))
+            amount = round(rnd.uniform(100, 50000), 2)
+            if rnd.random() < self.vat_subject_share:
+                income_account = data['vat_subject_account']
+            else:
+                income_account = data['no_vat_subject_account']
+            batch.append({
+                'journal_id': data['sale_journal'].id,
+                'date': date,
+                'line_ids': [
+                    (0, 0, {
+                        'account_id': data['receivable_account'].id,
+                        'name': 'Customer', 'debit': amount}),
+                    (0, 0, {
+                        'account_id': income_account.id,
+                        'name': 'Income', 'credit': amount}),
+                    ],
+                })
+            if len(batch) >= 500:
+                amo.create(batch)
+                batch = []
+        if batch:
+            amo.create(batch)
+        amo.flush()
+
+    def _benchmark_company(self, data, date_from, date_to, report):
+        company = data['company']
+        aml_count = self.env['account.move.line'].search_count([
+            ('company_id', '=', company.id),
+            ('journal_id', '=', data['purchase_journal'].id)])
+        prorata = self._create_vat_prorata(data, date_from, date_to)
+        sale_aml_count = self.env['account.move.line'].search_count([
+            ('company_id', '=', company.id),
+            ('journal_id', '=', data['sale_journal'].id)])
+        with self._measure(report, 'button_compute_ratio', sale_aml_count):
+            prorata.button_compute_ratio()
+        for engine in self.engines:
+            prorata = prorata.with_context(
+                vat_prorata_engine=engine, vat_prorata_full_recompute=True)
+            speedy = prorata._prepare_speed_dict()
+            move_ids = self.env['account.move'].search(
+                prorata._get_prorata_move_domain()).ids
+            with self._measure(
+                    report, 'classification (%s)' % engine, aml_count):
+                if engine == 'python':
+                    work_moves = prorata._prorata_work_moves_python(
+                        self.env['account.move'].browse(move_ids), speedy)
+                else:
+                    columns = prorata._prorata_columns_sql(move_ids, speedy)
+            with self._measure(
+                    report, 'expense_prorata_line_create (%s)' % engine,
+                    aml_count):
+                if engine == 'python':
+                    vals_list = prorata._prepare_prorata_lines(
+                        work_moves, speedy['currency'])
+                else:
+                    vals_list = prorata._prepare_prorata_lines_from_columns(
+                        columns, speedy)
+            self.env.clear()
+            with self._measure(
+                    report, 'generate_prorata_lines (%s)' % engine,
+                    aml_count):
+                prorata.generate_prorata_lines()
+                prorata.flush()
+        line_count = len(vals_list)
+        with self._measure(report, 'prepare_move', line_count):
+            move_vals = prorata.prepare_move()
+        with self._measure(report, 'account.move create', line_count):
+            prorata._create_prorata_moves([move_vals])
+            self.env['account.move'].flush()
+
+    def test_benchmark(self):
+        rnd = random.Random(self.seed)
+        today = fields.Date.context_today(self.env.user)
+        date_from = today + relativedelta(years=-1, month=1, day=1)
+        date_to = date_from + relativedelta(month=12, day=31)
+        report = []
+        for index in range(self.companies):
+            with self._measure(
+                    report, 'ledger generation',
+                    self.moves * (self.lines_per_move + 2) +
+                    self.sale_moves * 2):
+                data = self._create_vat_prorata_company(
+                    'VAT Pro Rata Benchmark %d' % index, self.tax_mix)
+                self._generate_ledger(data, date_from, date_to, rnd)
+            self._benchmark_company(data, date_from, date_to, report)
+        self.assertTrue(report)
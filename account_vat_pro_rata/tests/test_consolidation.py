@@ -0,0 +1,99 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from odoo.exceptions import UserError
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestConsolidation(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Consolidation', [20.0, 10.0])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        quarters = [
+            (date(2021, 1, 1), date(2021, 3, 31)),
+            (date(2021, 4, 1), date(2021, 6, 30)),
+            (date(2021, 7, 1), date(2021, 9, 30)),
+            (date(2021, 10, 1), date(2021, 12, 31)),
+            ]
+        # VAT subject and no VAT subject income of each quarter
+        incomes = [(1000.0, 0.0), (500.0, 500.0), (0.0, 300.0), (700.0, 200.0)]
+        cls.periods = cls.env['account.vat.prorata']
+        for i, ((date_from, date_to), (subject, nosubject)) in enumerate(
+                zip(quarters, incomes)):
+            move_date = date_from.replace(day=15)
+            cls._create_purchase_move(data, [
+                (expense[i], 100.0 + i, taxes[20.0]),
+                (expense[i + 4], 33.33 * (i + 1), taxes[10.0]),
+                ], round(20.0 + 0.2 * i + 3.333 * (i + 1), 2),
+                move_date=move_date)
+            if subject:
+                cls._create_sale_move(data, subject, move_date=move_date)
+            if nosubject:
+                cls._create_sale_move(
+                    data, nosubject, data['no_vat_subject_account'],
+                    move_date=move_date)
+            period = cls._create_vat_prorata(data, date_from, date_to)
+            period.button_compute_ratio()
+            # same ratio on all the periods, so that the consolidation
+            # with this ratio gives the same lines
+            period.write({'used_perct': 60.0})
+            period.button_generate_move()
+            cls.periods |= period
+        cls.consolidation = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31), consolidation=True)
+
+    def _get_lines(self, proratas):
+        return sorted(
+            (line.line_id.id, line.counterpart_amount, line.prorata_vat_amount)
+            for line in proratas.mapped('line_ids'))
+
+    def test_consolidation_ratio(self):
+        self.assertEqual(self.periods.mapped('state'), ['done'] * 4)
+        consolidation = self.consolidation
+        self.assertEqual(consolidation.consolidated_prorata_ids, self.periods)
+        consolidation.button_compute_ratio()
+        self.assertEqual(consolidation.state, 'ratio')
+        # ratio of the year, not the average of the ratios of the periods
+        self.assertEqual(consolidation.computed_perct, 68.75)
+        self.assertEqual(
+            sum(consolidation.subject_line_ids.mapped('balance')),
+            sum(self.periods.mapped('subject_line_ids.balance')))
+
+    def test_consolidation_lines(self):
+        consolidation = self.consolidation
+        consolidation.button_compute_ratio()
+        consolidation.write({'used_perct': 60.0})
+        consolidation.button_generate_move()
+        self.assertEqual(consolidation.state, 'done')
+        self.assertTrue(consolidation.move_ids)
+        self.assertEqual(
+            self._get_lines(consolidation), self._get_lines(self.periods))
+
+    def test_consolidation_period_not_done(self):
+        self.periods[1].button_back2draft()
+        with self.assertRaises(UserError):
+            self.consolidation.button_compute_ratio()
+
+    def test_vat_return_ignores_consolidation(self):
+        # the consolidation and the last period end on the same date
+        consolidation = self.consolidation
+        consolidation.button_compute_ratio()
+        consolidation.write({'used_perct': 60.0})
+        consolidation.button_generate_move()
+        self.periods[-1].write({'used_perct': 55.0})
+        vat_return = self.env['l10n.fr.account.vat.return'].new({
+            'company_id': self.data['company'].id,
+            'end_date': date(2021, 12, 31),
+            })
+        self.assertEqual(
+            vat_return._get_vat_prorata_ratios(), {vat_return.id: 55.0})
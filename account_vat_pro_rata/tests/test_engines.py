@@ -0,0 +1,130 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestEngines(VatProrataCommon):
+    """The SQL engine, the python engine and the streaming mode must
+    give the same VAT pro rata lines, cent for cent"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Engines', [20.0, 10.0, 5.5])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        # first tax by sequence, archived after the creation of the moves
+        cls.archived_tax = taxes[20.0].copy({
+            'name': 'Archived purchase VAT 20 %', 'sequence': 0})
+        taxes[10.0].write({'sequence': 5})
+        cls.moves = cls.env['account.move']
+        # VAT + other_tax lines with different rates:
+        # the remainder goes to the last line
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[0], 10.0, taxes[20.0]),
+            (expense[1], 20.0, taxes[10.0]),
+            (expense[2], 5.0, taxes[5.5]),
+            ], 33.33)
+        # other_tax and other_notax lines in the same move
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[3], 123.45, taxes[20.0]),
+            (expense[4], 67.89, False),
+            (expense[5], 0.01, taxes[5.5]),
+            ], 24.69)
+        # only other_notax lines
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[6], 1000.0, False),
+            (expense[7], 333.33, False),
+            (expense[8], 333.33, False),
+            ], 200.0)
+        # several taxes per line: the first one by sequence is used,
+        # and the archived one is ignored
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[0], 99.99, taxes[20.0] | taxes[10.0]),
+            (expense[1], 49.99, cls.archived_tax | taxes[5.5]),
+            (expense[2], 0.03, cls.archived_tax | taxes[20.0]),
+            ], 12.75)
+        # negative amounts (refund)
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[3], -45.67, taxes[20.0]),
+            (expense[4], -12.34, taxes[10.0]),
+            ], -10.37)
+        cls.archived_tax.active = False
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31), used_perct=73.11)
+
+    def _generate(self, **context):
+        prorata = self.prorata.with_context(
+            vat_prorata_full_recompute=True, **context)
+        prorata.generate_prorata_lines()
+        prorata.flush()
+        prorata.invalidate_cache()
+        return sorted(
+            (
+                line.line_id.id, line.counterpart_amount,
+                line.prorata_vat_amount, line.vat_rate,
+                line.original_amount, line.original_vat_amount)
+            for line in prorata.line_ids)
+
+    def test_engines_identical(self):
+        python_lines = self._generate(vat_prorata_engine='python')
+        self.assertTrue(python_lines)
+        sql_lines = self._generate(vat_prorata_engine='sql')
+        self.assertEqual(sql_lines, python_lines)
+        for engine in ('sql', 'python'):
+            # one move per chunk, and all the moves at once
+            for chunk_size in (1, 0):
+                streaming_lines = self._generate(
+                    vat_prorata_engine=engine,
+                    vat_prorata_move_chunk_size=chunk_size)
+                self.assertEqual(streaming_lines, python_lines)
+
+    def test_archived_tax_ignored(self):
+        lines = self.moves.mapped('line_ids').filtered(
+            lambda x: self.archived_tax in x.with_context(
+                active_test=False).tax_ids)
+        self.assertTrue(lines)
+        self._generate(vat_prorata_engine='sql')
+        for line in lines:
+            self.assertEqual(
+                line.vat_prorata_rate, line.tax_ids[0].amount)
+
+    def test_vat_allocated(self):
+        self._generate(vat_prorata_engine='sql')
+        ccur = self.prorata.company_currency_id
+        for move in self.moves:
+            lines = self.prorata.line_ids.filtered(
+                lambda x: x.move_id == move)
+            self.assertFalse(ccur.compare_amounts(
+                sum(lines.mapped('prorata_vat_amount')),
+                sum(lines.mapped('counterpart_amount'))))
+
+    def test_remainder_line_identical(self):
+        # many lines in one move: the total weight is a float sum whose
+        # result depends on the order of the lines
+        data = self.data
+        taxes = data['taxes']
+        expense_lines = []
+        for i, amount in enumerate([
+                0.1, 0.2, 0.3, 1234.57, 0.07, 99.99, 3.33, 0.01, 45.45,
+                7.77, 0.7, 12.34]):
+            expense_lines.append((
+                data['expense_accounts'][i % 10], amount,
+                taxes[[20.0, 10.0, 5.5][i % 3]]))
+        move = self._create_purchase_move(data, expense_lines, 147.21)
+        remainder_line = move.line_ids.filtered(
+            lambda x: x.account_id in data['expense_accounts'] and
+            x.tax_ids).sorted('id')[-1]
+        res = {}
+        for engine in ('python', 'sql'):
+            lines = self._generate(vat_prorata_engine=engine)
+            res[engine] = [x for x in lines if x[0] == remainder_line.id]
+        self.assertTrue(res['python'])
+        self.assertEqual(res['sql'], res['python'])
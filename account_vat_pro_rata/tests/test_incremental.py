@@ -0,0 +1,101 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from datetime import date, datetime
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestIncremental(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Incremental', [20.0, 10.0])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        cls.moves = cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], 50.0, taxes[10.0]),
+            ], 25.0)
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[2], 80.0, taxes[20.0]),
+            ], 16.0, move_date=date(2021, 2, 1))
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[3], 12.34, False),
+            (expense[4], 56.78, taxes[10.0]),
+            ], 7.91, move_date=date(2021, 9, 9))
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31), used_perct=62.5)
+
+    def _get_lines(self):
+        self.prorata.invalidate_cache()
+        return sorted(
+            (
+                line.line_id.id, line.counterpart_amount,
+                line.prorata_vat_amount, line.vat_rate,
+                line.original_amount, line.original_vat_amount)
+            for line in self.prorata.line_ids)
+
+    def _age_existing_data(self):
+        """All the journal entries existing now were written before the
+        watermark of the last generation"""
+        self.env['account.move'].flush()
+        self.env['account.move.line'].flush()
+        self.env.cr.execute(
+            "UPDATE account_move SET write_date=%s WHERE id IN %s",
+            (datetime(2000, 1, 1), tuple(self.moves.ids)))
+        self.env.cr.execute(
+            "UPDATE account_move_line SET write_date=%s WHERE move_id IN %s",
+            (datetime(2000, 1, 1), tuple(self.moves.ids)))
+        self.prorata.write({'prorata_watermark': datetime(2001, 1, 1)})
+        self.env['account.move'].invalidate_cache()
+        self.env['account.move.line'].invalidate_cache()
+
+    def test_incremental_equals_full(self):
+        prorata = self.prorata
+        prorata.generate_prorata_lines()
+        self._age_existing_data()
+        kept_move = self.moves[0]
+        kept_line_ids = set(prorata.line_ids.filtered(
+            lambda x: x.move_id == kept_move).ids)
+        # change a single journal entry
+        move = self.moves[1]
+        expense_line = move.line_ids.filtered(
+            lambda x: x.account_id == self.data['expense_accounts'][2])
+        payable_line = move.line_ids.filtered(
+            lambda x: x.account_id == self.data['payable_account'])
+        move.button_draft()
+        move.with_context(check_move_validity=False).write({'line_ids': [
+            (1, expense_line.id, {'debit': 90.0}),
+            (1, payable_line.id, {'credit': 106.0}),
+            ]})
+        move.action_post()
+        prorata.generate_prorata_lines()
+        incremental_lines = self._get_lines()
+        # the lines of the unchanged entries are not generated again
+        self.assertTrue(kept_line_ids)
+        self.assertTrue(kept_line_ids <= set(prorata.line_ids.ids))
+        prorata.with_context(
+            vat_prorata_full_recompute=True).generate_prorata_lines()
+        self.assertEqual(incremental_lines, self._get_lines())
+
+    def test_back2draft_resets_results(self):
+        prorata = self.prorata
+        prorata.generate_prorata_lines()
+        self.assertTrue(prorata.line_count)
+        self.assertTrue(prorata.line_summary_ids)
+        prorata.write({'state': 'done'})
+        prorata.button_back2draft()
+        prorata.invalidate_cache()
+        self.assertEqual(prorata.state, 'draft')
+        self.assertEqual(prorata.line_count, 0)
+        self.assertFalse(prorata.line_summary_ids)
+        self.assertFalse(prorata.anomaly_count)
+        # the lines are kept for the incremental generation
+        self.assertTrue(prorata.line_ids)
+        self.assertTrue(prorata.prorata_watermark)
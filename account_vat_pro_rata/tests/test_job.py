@@ -0,0 +1,114 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from odoo.exceptions import UserError
+from datetime import date, datetime
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestJob(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Job', [20.0])
+        cls._create_purchase_move(data, [
+            (data['expense_accounts'][0], 100.0, data['taxes'][20.0]),
+            ], 20.0)
+        cls._create_sale_move(data, 1000.0)
+        cls._create_sale_move(data, 250.0, data['no_vat_subject_account'])
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31))
+        cls.job_obj = cls.env['account.vat.prorata.job']
+
+    def setUp(self):
+        super().setUp()
+        # the jobs are claimed and run in separate cursors, which must
+        # see the data of the test transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+
+    def _enqueue(self, action):
+        job = self.job_obj._enqueue(self.prorata, action)
+        self.env['base'].flush()
+        return job
+
+    def _run_next_job(self, job):
+        self.assertEqual(self.job_obj._claim_next_job(), job.id)
+        job.invalidate_cache()
+        self.assertEqual(job.state, 'running')
+        self.assertTrue(job.date_start)
+        res = self.job_obj._run_job(job.id)
+        self.env['base'].invalidate_cache()
+        return res
+
+    def test_job_claim_and_run(self):
+        job = self._enqueue('compute_ratio')
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(self.prorata.job_ids, job)
+        self.assertTrue(self._run_next_job(job))
+        # nothing left to claim
+        self.assertFalse(self.job_obj._claim_next_job())
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.progress, 100.0)
+        self.assertTrue(job.date_end)
+        self.assertEqual(self.prorata.state, 'ratio')
+        self.assertEqual(self.prorata.computed_perct, 80.0)
+
+    def test_job_failure(self):
+        self.data['company'].write({'vat_prorata': False})
+        job = self._enqueue('compute_ratio')
+        self.assertFalse(self._run_next_job(job))
+        self.assertEqual(job.state, 'failed')
+        self.assertIn("doesn't have VAT Prorata", job.error)
+        # the computation was rolled back
+        self.assertEqual(self.prorata.state, 'draft')
+        self.assertFalse(self.prorata.subject_line_ids)
+
+    def test_job_failure_anomalies(self):
+        # deductible VAT without expense line
+        data = self.data
+        self._create_purchase_move(data, [], 10.0)
+        self.prorata.write({'state': 'ratio', 'used_perct': 80.0})
+        job = self._enqueue('generate_move')
+        self.assertFalse(self._run_next_job(job))
+        self.assertEqual(job.state, 'failed')
+        self.assertIn('1 source journal entries with anomalies', job.error)
+        self.assertEqual(self.prorata.state, 'ratio')
+        self.assertEqual(self.prorata.anomaly_count, 1)
+        self.assertFalse(self.prorata.move_ids)
+
+    def test_job_cancel(self):
+        job = self._enqueue('compute_ratio')
+        with self.assertRaises(UserError):
+            self.prorata.button_compute_ratio()
+        job.button_cancel()
+        self.assertEqual(job.state, 'cancelled')
+        self.assertTrue(job.date_end)
+        self.assertFalse(self.job_obj._claim_next_job())
+        self.prorata.button_compute_ratio()
+        self.assertEqual(self.prorata.state, 'ratio')
+
+    def test_job_cancel_running(self):
+        job = self._enqueue('compute_ratio')
+        self.assertEqual(self.job_obj._claim_next_job(), job.id)
+        job.invalidate_cache()
+        # claimed just now: the worker may not have locked the record yet
+        with self.assertRaises(UserError):
+            job.button_cancel()
+        self.assertEqual(job.state, 'running')
+        # claimed long ago and the record is not locked: the worker is gone
+        self.env.cr.execute(
+            "UPDATE account_vat_prorata_job SET date_start=%s WHERE id=%s",
+            (datetime(2000, 1, 1), job.id))
+        job.invalidate_cache()
+        job.button_cancel()
+        self.assertEqual(job.state, 'failed')
+        self.assertTrue(job.error)
+        self.prorata.button_compute_ratio()
+        self.assertEqual(self.prorata.state, 'ratio')
@@ -0,0 +1,98 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from collections import defaultdict
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestMoveSplit(VatProrataCommon):
+    """The VAT pro rata entries split by month or by number of lines must
+    be balanced and cover the same amounts as the single entry"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Split', [20.0, 10.0, 5.5])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], 33.33, taxes[10.0]),
+            ], 23.33, move_date=date(2021, 1, 10))
+        cls._create_purchase_move(data, [
+            (expense[2], 45.67, taxes[5.5]),
+            ], 2.51, move_date=date(2021, 1, 31))
+        cls._create_purchase_move(data, [
+            (expense[0], 12.34, taxes[20.0]),
+            (expense[3], 56.78, False),
+            ], 2.47, move_date=date(2021, 3, 1))
+        cls._create_purchase_move(data, [
+            (expense[4], 250.0, taxes[20.0]),
+            (expense[5], 0.07, taxes[10.0]),
+            ], 50.01, move_date=date(2021, 6, 30))
+        cls._create_purchase_move(data, [
+            (expense[1], -20.0, taxes[10.0]),
+            ], -2.0, move_date=date(2021, 11, 2))
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31), used_perct=41.37)
+
+    def _get_account_totals(self, lines_vals):
+        res = defaultdict(float)
+        for lvals in lines_vals:
+            res[lvals['account_id']] += \
+                lvals.get('debit', 0.0) - lvals.get('credit', 0.0)
+        return {
+            account_id: round(amount, 2)
+            for (account_id, amount) in res.items()}
+
+    def _generate(self, **vals):
+        prorata = self.prorata
+        prorata.write(vals)
+        prorata.generate_prorata_lines()
+        # amounts of the single VAT pro rata entry
+        single_totals = self._get_account_totals(
+            [x[2] for x in prorata.prepare_move()['line_ids']])
+        self.assertTrue(single_totals)
+        prorata.button_generate_move()
+        self.assertEqual(prorata.state, 'done')
+        moves = prorata.move_ids
+        ccur = prorata.company_currency_id
+        for move in moves:
+            self.assertEqual(move.journal_id, prorata.journal_id)
+            self.assertFalse(ccur.compare_amounts(
+                sum(move.line_ids.mapped('debit')),
+                sum(move.line_ids.mapped('credit'))))
+        self.assertEqual(
+            self._get_account_totals([{
+                'account_id': line.account_id.id,
+                'debit': line.debit,
+                'credit': line.credit,
+                } for line in moves.mapped('line_ids')]),
+            single_totals)
+        return moves
+
+    def test_split_none(self):
+        moves = self._generate(move_split='none')
+        self.assertEqual(len(moves), 1)
+        self.assertEqual(moves.date, date(2021, 12, 31))
+
+    def test_split_by_month(self):
+        moves = self._generate(move_split='month')
+        self.assertEqual(
+            sorted(moves.mapped('date')), [
+                date(2021, 1, 31), date(2021, 3, 31), date(2021, 6, 30),
+                date(2021, 11, 30)])
+
+    def test_split_by_lines(self):
+        # each source journal entry gives at most 3 lines
+        moves = self._generate(move_split='lines', move_split_max_lines=3)
+        self.assertTrue(len(moves) > 1)
+        for move in moves:
+            self.assertTrue(len(move.line_ids) <= 3)
+            self.assertEqual(move.date, date(2021, 12, 31))
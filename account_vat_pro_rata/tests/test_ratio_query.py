@@ -0,0 +1,33 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestRatioQuery(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Ratio Query', [20.0])
+        cls.prorata = cls._create_vat_prorata(
+            cls.data, date(2021, 1, 1), date(2021, 12, 31))
+
+    def test_ratio_query_uses_index(self):
+        request, params = self.prorata._get_ratio_rows_query()
+        self.prorata.flush()
+        # the database of the tests is small: sequential scans are
+        # disabled to check that the query *can* use the index
+        self.env.cr.execute('SET LOCAL enable_seqscan = off')
+        try:
+            self.env.cr.execute('EXPLAIN ' + request, params)
+            plan = '\n'.join(row[0] for row in self.env.cr.fetchall())
+        finally:
+            self.env.cr.execute('RESET enable_seqscan')
+        self.assertIn('account_move_line_vat_prorata_idx', plan)
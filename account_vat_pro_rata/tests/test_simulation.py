@@ -0,0 +1,76 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests import tagged
+from datetime import date
+
+from .common import VatProrataCommon
+
+
+@tagged('post_install', '-at_install')
+class TestSimulation(VatProrataCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data = data = cls._create_vat_prorata_company(
+            'VAT Pro Rata Simulation', [20.0, 10.0])
+        taxes = data['taxes']
+        expense = data['expense_accounts']
+        cls.moves = cls._create_purchase_move(data, [
+            (expense[0], 100.0, taxes[20.0]),
+            (expense[1], 33.33, taxes[10.0]),
+            (expense[2], 12.5, False),
+            ], 23.33)
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[0], 45.67, taxes[20.0]),
+            (expense[3], 0.07, taxes[20.0]),
+            ], 9.15, move_date=date(2021, 3, 2))
+        cls.moves |= cls._create_purchase_move(data, [
+            (expense[4], 250.0, False),
+            ], 50.0, move_date=date(2021, 11, 30))
+        cls.prorata = cls._create_vat_prorata(
+            data, date(2021, 1, 1), date(2021, 12, 31))
+
+    def _get_move_amounts(self, ratio):
+        self.prorata.write({'used_perct': ratio})
+        self.prorata.with_context(
+            vat_prorata_full_recompute=True).generate_prorata_lines()
+        res = {}
+        for lvals in self.prorata.prepare_move()['line_ids']:
+            lvals = lvals[2]
+            debit = lvals.get('debit', 0.0)
+            credit = lvals.get('credit', 0.0)
+            if debit or credit:
+                res[(
+                    lvals['account_id'], lvals['start_date'],
+                    lvals['end_date'])] = (debit, credit)
+        return res
+
+    def test_simulation_equals_move(self):
+        ratios = [0.0, 37.5, 73.11, 99.99]
+        simulations = self.prorata.simulate_ratios(ratios)
+        self.assertEqual([x['ratio'] for x in simulations], ratios)
+        for simulation in simulations:
+            simulated = {
+                (x['account_id'], x['start_date'], x['end_date']):
+                (x['debit'], x['credit']) for x in simulation['lines']}
+            self.assertEqual(
+                simulated, self._get_move_amounts(simulation['ratio']),
+                'ratio %s' % simulation['ratio'])
+            self.assertAlmostEqual(
+                simulation['total_debit'], simulation['total_credit'])
+
+    def test_simulation_read_only(self):
+        company = self.data['company']
+        company.write({'vat_prorata_kind_signature': False})
+        lines = self.moves.mapped('line_ids')
+        lines.flush()
+        self.env.cr.execute(
+            "UPDATE account_move_line SET vat_prorata_kind=NULL "
+            "WHERE id IN %s", (tuple(lines.ids), ))
+        lines.invalidate_cache()
+        self.assertTrue(self.prorata.simulate_ratios([50.0])[0]['lines'])
+        self.assertFalse(company.vat_prorata_kind_signature)
+        self.assertFalse(any(lines.mapped('vat_prorata_kind')))
@@ -1 +1,2 @@
 from . import res_config_settings
+from . import account_vat_prorata_simulation
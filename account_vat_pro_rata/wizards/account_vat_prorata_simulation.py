@@ -0,0 +1,88 @@
+# Copyright 2022 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+
+class AccountVatProrataSimulation(models.TransientModel):
+    _name = 'account.vat.prorata.simulation'
+    _description = 'VAT Pro Rata Ratio Simulation'
+
+    prorata_id = fields.Many2one(
+        'account.vat.prorata', string='VAT Pro Rata', required=True,
+        readonly=True)
+    company_currency_id = fields.Many2one(
+        related='prorata_id.company_currency_id')
+    ratios = fields.Char(
+        string='Ratios (%)', required=True,
+        help="List of ratios separated by commas, for example '70, 75, 80'")
+    line_ids = fields.One2many(
+        'account.vat.prorata.simulation.line', 'simulation_id',
+        string='Simulated Lines', readonly=True)
+
+    @api.model
+    def default_get(self, fields_list):
+        res = super().default_get(fields_list)
+        if self._context.get('active_model') == 'account.vat.prorata':
+            prorata = self.env['account.vat.prorata'].browse(
+                self._context.get('active_id'))
+            if prorata.consolidation:
+                raise UserError(_(
+                    "The simulation is not available on a consolidation."))
+            res['prorata_id'] = prorata.id
+            res['ratios'] = '%s' % prorata.used_perct
+        return res
+
+    def _get_ratios(self):
+        try:
+            ratios = [
+                float(ratio) for ratio in self.ratios.split(',')
+                if ratio.strip()]
+        except ValueError:
+            raise UserError(_(
+                "The ratios '%s' are not a list of numbers separated "
+                "by commas.") % self.ratios)
+        if not ratios or any(ratio < 0 or ratio > 100 for ratio in ratios):
+            raise UserError(_("The ratios must be between 0 and 100."))
+        return ratios
+
+    def run(self):
+        self.ensure_one()
+        self.line_ids.unlink()
+        vals_list = []
+        for res in self.prorata_id.simulate_ratios(self._get_ratios()):
+            for line in res['lines']:
+                vals_list.append({
+                    'simulation_id': self.id,
+                    'ratio': res['ratio'],
+                    'account_id': line['account_id'],
+                    'start_date': line['start_date'],
+                    'end_date': line['end_date'],
+                    'debit': line['debit'],
+                    'credit': line['credit'],
+                    })
+        self.env['account.vat.prorata.simulation.line'].create(vals_list)
+        action = self.env['ir.actions.actions']._for_xml_id(
+            'account_vat_pro_rata.account_vat_prorata_simulation_action')
+        action['res_id'] = self.id
+        return action
+
+
+class AccountVatProrataSimulationLine(models.TransientModel):
+    _name = 'account.vat.prorata.simulation.line'
+    _description = 'VAT Pro Rata Ratio Simulation Line'
+    _order = 'ratio, id'
+
+    simulation_id = fields.Many2one(
+        'account.vat.prorata.simulation', string='Simulation',
+        required=True, ondelete='cascade')
+    company_currency_id = fields.Many2one(
+        related='simulation_id.company_currency_id')
+    ratio = fields.Float(string='Ratio (%)', digits='VAT Pro Rata Ratio')
+    account_id = fields.Many2one('account.account', string='Account')
+    start_date = fields.Date()
+    end_date = fields.Date()
+    debit = fields.Monetary(currency_field='company_currency_id')
+    credit = fields.Monetary(currency_field='company_currency_id')
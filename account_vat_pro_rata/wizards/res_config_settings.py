@@ -13,3 +13,9 @@ class ResConfigSettings(models.TransientModel):
         related='company_id.vat_prorata_journal_id', readonly=False,
         domain="[('type', '=', 'general'), ('company_id', '=', company_id)]",
         )
+    vat_prorata_engine = fields.Selection(
+        related='company_id.vat_prorata_engine', readonly=False)
+    vat_prorata_trace = fields.Boolean(
+        related='company_id.vat_prorata_trace', readonly=False)
+    vat_prorata_provisional_perct = fields.Float(
+        related='company_id.vat_prorata_provisional_perct')